@@ -0,0 +1,234 @@
+#!/usr/bin/python
+"""Time collection cycles without touching Launchpad, LeanKit or the live
+database.
+
+Each scale runs in its own process against a fake Launchpad and LeanKit
+(collectors/fake_server.py) and a scratch database on a local MongoDB. For
+every step we report wall time, HTTP requests by status, MongoDB commands
+and the peak memory of the process.
+
+    ./benchmark.py --scales 100,1000,10000 --latency 0.05
+
+--save-fixture writes the database each scale ends up with to an archive
+(see collectors/archive.py), and --fixture loads one before the first step,
+so later runs, or a web server load test, can start from the same data.
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+import traceback
+
+from pymongo import monitoring
+
+from collectors import archive, collect_lp_bugs, collect_lp_people, leankit
+from collectors import utils
+from collectors.utils import LaunchpadError
+from collectors.fake_server import FakeData, FakeServer, redirect
+
+
+class CommandCounter(monitoring.CommandListener):
+    """Counts MongoDB commands by name and collection"""
+    def __init__(self):
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, basestring):
+            collection = ''
+        with self._lock:
+            key = (event.command_name, collection)
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def reset(self):
+        with self._lock:
+            counts, self.counts = self.counts, {}
+        return counts
+
+
+def seed(db):
+    """Store the Launchpad OAuth tokens the collectors expect to find"""
+    token = {'oauth_token': 'bench', 'oauth_token_secret': 'bench',
+             'oauth_consumer_key': 'next_up'}
+    for name in ('lp_oauth', 'lp_oauth_access'):
+        doc = dict(token, name=name)
+        db['server_auth'].replace_one({'name': name}, doc, upsert=True)
+
+
+class Quiet:
+    """Hide what the collectors print while a step is running"""
+    def __init__(self, verbose):
+        self.verbose = verbose
+
+    def __enter__(self):
+        if not self.verbose:
+            self._stdout = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, type, value, traceback):
+        if not self.verbose:
+            sys.stdout.close()
+            sys.stdout = self._stdout
+
+
+def unchanged(args):
+    """Poll again with nothing changed upstream. Only changes to documents
+    count, so there must be none."""
+    changes = collect_lp_bugs.collect(workers=args.workers,
+                                      batch_size=args.batch_size)
+    if changes:
+        raise AssertionError("{} changes from a poll that found nothing new"
+                             .format(changes))
+
+
+def search_fails(db, data, args):
+    """Collect with Launchpad failing every search. A search that fails
+    mustn't look like one that found nothing, so no bug may be deleted."""
+    stored = db['bugs_filtered'].count()
+    data.failing['searchTasks'] = 404
+    try:
+        collect_lp_bugs.collect(workers=args.workers,
+                                batch_size=args.batch_size, full=True)
+    except LaunchpadError:
+        pass
+    else:
+        raise AssertionError("Collecting didn't fail")
+    finally:
+        del data.failing['searchTasks']
+    left = db['bugs_filtered'].count()
+    if left != stored:
+        raise AssertionError("{} of {} bugs deleted after a failed search"
+                             .format(stored - left, stored))
+
+
+def run_scale(scale, args, results):
+    try:
+        results.put(measure(scale, args))
+    except Exception:
+        results.put((scale, None, traceback.format_exc()))
+
+
+def measure(scale, args):
+    # The collectors all use utils.db, which connects on first use
+    counter = CommandCounter()
+    utils.db.configure(args.mongo, args.db, event_listeners=[counter])
+    db = utils.db
+    db.client.drop_database(args.db)
+    seed(db)
+    if args.fixture:
+        with Quiet(args.verbose):
+            archive.import_archive(db, args.fixture)
+
+    data = FakeData(bugs=scale, team_members=max(10, scale / 10))
+    server = FakeServer(data, latency=args.latency).start()
+    redirect(utils.get_session(args.workers * 2), server)
+
+    settings = {'leankit_board': data.board_id, 'leankit_user': 'bench',
+                'leankit_pass': 'bench', 'leankit_name': 'bench'}
+    steps = [
+        ('bugs cold', lambda: collect_lp_bugs.collect(
+            workers=args.workers, batch_size=args.batch_size)),
+        ('bugs unchanged', lambda: unchanged(args)),
+        ('bugs modified', lambda: (
+            data.modify(range(1, scale + 1, 20)),
+            collect_lp_bugs.collect(workers=args.workers,
+                                    batch_size=args.batch_size))),
+        ('bugs full', lambda: collect_lp_bugs.collect(
+            workers=args.workers, batch_size=args.batch_size, full=True)),
+        ('search fails', lambda: search_fails(db, data, args)),
+        ('people', lambda: collect_lp_people.collect(['bench-team'])),
+        ('cards', lambda: leankit.collect(settings)),
+    ]
+
+    rows = []
+    counter.reset()
+    for name, step in steps:
+        start = time.time()
+        with Quiet(args.verbose):
+            step()
+        wall = time.time() - start
+        http = server.reset_counts()
+        mongo = counter.reset()
+        rows.append({
+            'step': name,
+            'wall': wall,
+            'http_200': sum(n for (_, s), n in http.items() if s == 200),
+            'http_304': sum(n for (_, s), n in http.items() if s == 304),
+            'http_other': sum(n for (_, s), n in http.items()
+                              if s not in (200, 304)),
+            'mongo': sum(mongo.values()),
+            'mongo_by_command': mongo,
+        })
+
+    server.stop()
+    if args.save_fixture:
+        with open(args.save_fixture.format(scale=scale), 'wb') as f, \
+                Quiet(args.verbose):
+            archive.export_archive(db, f)
+    db.client.drop_database(args.db)
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return scale, rows, peak
+
+
+def report(scale, rows, peak, verbose):
+    if rows is None:
+        print "{} bugs failed:".format(scale)
+        print peak
+        return
+    print "{} bugs, peak memory {:.1f} MB".format(scale, peak)
+    print "  {:<14} {:>9} {:>8} {:>8} {:>6} {:>8}".format(
+        'step', 'wall (s)', 'http 200', 'http 304', 'other', 'mongo')
+    for row in rows:
+        print "  {step:<14} {wall:9.2f} {http_200:8} {http_304:8} " \
+            "{http_other:6} {mongo:8}".format(**row)
+        if verbose:
+            for (command, collection), n in sorted(
+                    row['mongo_by_command'].items()):
+                print "      {:<12} {:<20} {}".format(command, collection, n)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scales', default='100,1000',
+                        help='comma separated numbers of bugs')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every fake HTTP response')
+    parser.add_argument('--workers', type=int,
+                        default=collect_lp_bugs.DEFAULT_WORKERS)
+    parser.add_argument('--batch-size', type=int,
+                        default=utils.DEFAULT_BATCH_SIZE)
+    parser.add_argument('--mongo', default='mongodb://localhost:27017/')
+    parser.add_argument('--db', default='juju_team_status_bench')
+    parser.add_argument('--fixture', metavar='ARCHIVE',
+                        help='load ARCHIVE into the database first')
+    parser.add_argument('--save-fixture', metavar='ARCHIVE',
+                        help='save the database after each scale to '
+                        'ARCHIVE, where {scale} is replaced by the scale')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show collector output and MongoDB commands')
+    args = parser.parse_args()
+
+    results = multiprocessing.Queue()
+    for scale in [int(s) for s in args.scales.split(',')]:
+        p = multiprocessing.Process(target=run_scale,
+                                    args=(scale, args, results))
+        p.start()
+        result = results.get()
+        p.join()
+        report(*(result + (args.verbose,)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,135 @@
 #!/usr/bin/python
 
-from collectors import collect_lp_bugs, collect_lp_people
-import time
+from collectors import collect_lp_bugs, collect_lp_people, leankit, utils
+from collectors import metrics, refresh, schema, storage
+from collectors.scheduler import Scheduler, Source
+import argparse
 import yaml
 import os
 
 
 BASE_DIR = os.path.dirname(__file__)
 
+parser = argparse.ArgumentParser()
+parser.add_argument('--profile', action='append', default=[],
+                    metavar='SOURCE',
+                    help='profile the first run of SOURCE with cProfile')
+args = parser.parse_args()
+
 with open(os.path.join(BASE_DIR, '..', 'settings.yaml')) as s:
     settings = yaml.load(s.read())
 
+# Keep only the fields of Launchpad objects we use, see collectors/storage.py
+storage.configure(settings.get('compact_storage', False))
+
+# Create and update indexes, and refuse to start if any query we make often
+# would scan a whole collection, see collectors/schema.py
+schema.ensure(utils.db)
+schema.check(utils.db)
+
+# Bugs stored before more than one project was collected are stored again
+collect_lp_bugs.remove_legacy_bugs()
+
+# All collectors share one pool of keep-alive connections, and the same
+# timeouts
+utils.get_session(settings.get('http_pool_size', utils.DEFAULT_POOL_SIZE),
+                  (settings.get('http_connect_timeout', utils.CONNECT_TIMEOUT),
+                   settings.get('http_read_timeout', utils.READ_TIMEOUT)))
+cache = utils.get_cache(**settings.get('web_cache', {}))
+
+# Counters and latency histograms are served in the Prometheus text format
+metrics.registry.add_gauges(lambda: [
+    ('web_cache_' + k, v) for k, v in sorted(cache.counters.items())])
+metrics.serve(settings.get('metrics_port', 9875))
+
+# Make sure we can talk to Launchpad before starting to poll it
+utils.CollectorHelpers(None).lp_login()
+
+# How often to poll each source, in seconds. Each source starts at interval
+# and speeds up to min_interval while it keeps finding changes, or slows down
+# to max_interval while it doesn't. Any of these can be overridden in the
+# schedule section of settings.yaml.
+SCHEDULE = {
+    'lp_bugs': {'interval': 5 * 60, 'min_interval': 60,
+                'max_interval': 30 * 60},
+    'lp_people': {'interval': 60 * 60, 'min_interval': 30 * 60,
+                  'max_interval': 24 * 60 * 60},
+    'leankit_cards': {'interval': 5 * 60, 'min_interval': 60,
+                      'max_interval': 30 * 60},
+    'web_cache': {'interval': 10 * 60},
+}
+
+
+lp_projects = settings.get('lp_projects', collect_lp_bugs.DEFAULT_PROJECTS)
+lp_page_size = settings.get('lp_page_size', utils.DEFAULT_PAGE_SIZE)
+
+
+def collect_bugs():
+    return collect_lp_bugs.collect(
+        workers=settings.get('lp_workers', collect_lp_bugs.DEFAULT_WORKERS),
+        batch_size=settings.get('db_batch_size', utils.DEFAULT_BATCH_SIZE),
+        full_sync_interval=settings.get(
+            'lp_full_sync_interval', collect_lp_bugs.DEFAULT_FULL_SYNC_INTERVAL),
+        projects=lp_projects,
+        processes=settings.get('lp_processes'),
+        page_size=lp_page_size)
+
+
+def refresh_bugs(bug=None, milestone=None, project=None):
+    return collect_lp_bugs.refresh(
+        bug, milestone, [project] if project else lp_projects,
+        workers=settings.get('lp_workers', collect_lp_bugs.DEFAULT_WORKERS),
+        batch_size=settings.get('db_batch_size', utils.DEFAULT_BATCH_SIZE),
+        page_size=lp_page_size)
+
+
+def collect_people():
+    return collect_lp_people.collect(
+        settings['lp_teams'],
+        workers=settings.get('lp_workers', collect_lp_people.DEFAULT_WORKERS),
+        page_size=lp_page_size)
+
+
+def collect_cards():
+    return leankit.collect(
+        settings, workers=settings.get('leankit_workers',
+                                       leankit.DEFAULT_WORKERS))
+
+
+def clean_cache():
+    evicted = cache.evict()
+    print "Web cache:", ", ".join(
+        "{}={}".format(k, v) for k, v in sorted(cache.stats().items()))
+    # Old entries in the change log are cleaned up on the same schedule
+    trimmed = utils.get_change_log().trim()
+    return evicted + trimmed
+
+
+def source(name, fn):
+    options = dict(SCHEDULE[name])
+    options.update(settings.get('schedule', {}).get(name, {}))
+    return Source(name, fn, profile=name in args.profile, **options)
+
+
+sources = [
+    source('lp_bugs', collect_bugs),
+    source('lp_people', collect_people),
+    source('web_cache', clean_cache),
+]
+if 'leankit_board' in settings:
+    sources.append(source('leankit_cards', collect_cards))
 
-# People shouldn't change much, just refresh on start
-collect_lp_people.collect(settings['lp_teams'])
+# Single bugs, milestones and cards can be refreshed between polls, see
+# collectors/refresh.py
+handlers = {
+    'bug': lambda name, project: refresh_bugs(bug=int(name), project=project),
+    'milestone': lambda name, project: refresh_bugs(milestone=name,
+                                                    project=project),
+}
+if 'leankit_board' in settings:
+    handlers['card'] = lambda name, project: leankit.refresh_card(settings,
+                                                                  name)
+refresh.serve(refresh.Refresher(handlers), settings.get('control_port', 9876))
 
-# Poll these for changes
-while True:
-    print "Getting remote sources..."
-    collect_lp_bugs.collect()
-    print "--------"
-    time.sleep(5 * 60)
+Scheduler(sources, utils.db['collector_state'],
+          utils.db['collector_metrics']).run_forever()
@@ -0,0 +1,200 @@
+#!/usr/bin/python
+"""Export the collected data to a file, and import it somewhere else.
+
+An archive is a tar stream. Each collection is stored as numbered chunks of
+gzipped BSON documents, followed by a manifest that lists every chunk with
+its document count and SHA-256. Credentials and the web cache are never
+exported. Import checks every chunk against the manifest before it touches
+the database, loads the documents in bulk and only then builds the indexes.
+
+    ./archive.py export FILE [COLLECTION ...]
+    ./archive.py import FILE
+"""
+
+import gzip
+import hashlib
+import json
+import sys
+import tarfile
+import time
+from StringIO import StringIO
+
+from bson import decode_all
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+
+FORMAT = 1
+
+# What a new dashboard instance needs
+DEFAULT_COLLECTIONS = ('bugs_filtered', 'projects_meta', 'lp_teams',
+                       'lp_people', 'lp_membership', 'cards', 'bug_history')
+
+# Never exported: credentials, and the web cache which is large and can be
+# refilled by polling
+EXCLUDED = frozenset(['server_auth', 'web_cache', 'web_cache_bodies'])
+
+DEFAULT_CHUNK_SIZE = 1000
+
+_RAW_BSON = CodecOptions(document_class=RawBSONDocument)
+
+
+def _add(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = time.time()
+    tar.addfile(info, StringIO(data))
+
+
+def _gzip(data):
+    out = StringIO()
+    with gzip.GzipFile(fileobj=out, mode='wb', mtime=0) as f:
+        f.write(data)
+    return out.getvalue()
+
+
+def _chunks(collection, chunk_size):
+    """Yield lists of the raw BSON of up to chunk_size documents"""
+    chunk = []
+    cursor = collection.with_options(codec_options=_RAW_BSON).find(
+        sort=[('_id', 1)])
+    for doc in cursor:
+        chunk.append(doc.raw)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def export_archive(db, fileobj, collections=DEFAULT_COLLECTIONS,
+                   chunk_size=DEFAULT_CHUNK_SIZE):
+    """Write the collections to fileobj, which only needs to support
+    write(). Returns the manifest."""
+    excluded = EXCLUDED.intersection(collections)
+    if excluded:
+        raise ValueError("Won't export " + ", ".join(sorted(excluded)))
+
+    manifest = {'format': FORMAT, 'created': time.time(), 'collections': {}}
+    with tarfile.open(fileobj=fileobj, mode='w|') as tar:
+        for name in collections:
+            entry = {'count': 0, 'chunks': [], 'indexes': []}
+            for n, docs in enumerate(_chunks(db[name], chunk_size)):
+                data = _gzip(''.join(docs))
+                member = '{}/{:06d}.bson.gz'.format(name, n)
+                _add(tar, member, data)
+                entry['chunks'].append({
+                    'name': member, 'count': len(docs), 'bytes': len(data),
+                    'sha256': hashlib.sha256(data).hexdigest()})
+                entry['count'] += len(docs)
+            for index_name, info in db[name].index_information().iteritems():
+                if index_name == '_id_':
+                    continue
+                options = dict((k, v) for k, v in info.iteritems()
+                               if k not in ('key', 'v', 'ns'))
+                entry['indexes'].append({'name': index_name,
+                                         'key': info['key'],
+                                         'options': options})
+            manifest['collections'][name] = entry
+            print "Exported {} documents from {}".format(entry['count'], name)
+        _add(tar, 'manifest.json', json.dumps(manifest, indent=2,
+                                              sort_keys=True))
+    return manifest
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def _read_chunk(tar, chunk):
+    """The gzipped BSON of chunk, checked against its SHA-256"""
+    try:
+        data = tar.extractfile(chunk['name']).read()
+    except KeyError:
+        raise ArchiveError(chunk['name'] + " is missing")
+    if hashlib.sha256(data).hexdigest() != chunk['sha256']:
+        raise ArchiveError(chunk['name'] + " is corrupt")
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+
+def verify(tar, manifest):
+    """Raise ArchiveError unless every chunk in manifest is in tar, intact
+    and holds the number of documents the manifest says"""
+    for name, entry in sorted(manifest['collections'].iteritems()):
+        count = 0
+        for chunk in entry['chunks']:
+            docs = len(decode_all(_read_chunk(tar, chunk), _RAW_BSON))
+            if docs != chunk['count']:
+                raise ArchiveError("Expected {} documents in {}, found {}"
+                                   .format(chunk['count'], chunk['name'],
+                                           docs))
+            count += docs
+        if count != entry['count']:
+            raise ArchiveError("Expected {} documents in {}, found {}"
+                               .format(entry['count'], name, count))
+
+
+def import_archive(db, path, batch_size=DEFAULT_CHUNK_SIZE):
+    """Replace the collections in the archive at path with its contents.
+    Nothing is dropped unless the whole archive is intact. Returns the
+    manifest."""
+    with tarfile.open(path, mode='r:') as tar:
+        try:
+            manifest = json.load(tar.extractfile('manifest.json'))
+        except KeyError:
+            raise ArchiveError(path + " has no manifest")
+        if manifest.get('format') != FORMAT:
+            raise ArchiveError("Unknown archive format {}".format(
+                manifest.get('format')))
+        excluded = EXCLUDED.intersection(manifest['collections'])
+        if excluded:
+            raise ArchiveError(path + " contains " +
+                               ", ".join(sorted(excluded)))
+        verify(tar, manifest)
+
+        for name, entry in sorted(manifest['collections'].iteritems()):
+            start = time.time()
+            db[name].drop()
+            count = 0
+            for chunk in entry['chunks']:
+                docs = decode_all(_read_chunk(tar, chunk))
+                for i in range(0, len(docs), batch_size):
+                    db[name].insert_many(docs[i:i + batch_size],
+                                         ordered=False)
+                count += len(docs)
+
+            # Building indexes once the data is in is quicker than
+            # maintaining them during the load
+            for index in entry['indexes']:
+                options = dict((str(k), v)
+                               for k, v in index['options'].iteritems())
+                options['name'] = index['name']
+                db[name].create_index([tuple(k) for k in index['key']],
+                                      **options)
+            duration = time.time() - start
+            print "Imported {} documents into {} in {:.2f}s".format(
+                count, name, duration)
+    return manifest
+
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[1] not in ('export', 'import'):
+        print "usage: archive.py export FILE [COLLECTION ...]"
+        print "       archive.py import FILE"
+        sys.exit(1)
+    from utils import db, get_change_log
+    import snapshots
+
+    path = sys.argv[2]
+    if sys.argv[1] == 'export':
+        collections = sys.argv[3:] or DEFAULT_COLLECTIONS
+        with open(path, 'wb') as f:
+            export_archive(db, f, collections)
+    else:
+        import_archive(db, path)
+        # Views and open dashboards need to catch up with the new data
+        snapshots.build(db, get_change_log().reset())
+
+
+if __name__ == '__main__':
+    main()
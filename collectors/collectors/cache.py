@@ -0,0 +1,293 @@
+import hashlib
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from bson.binary import Binary
+
+
+class MemoryLRU:
+    """A small in-process least recently used cache, bounded by the total size
+    of the values it holds."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        value = self._entries.pop(key, None)
+        if value is not None:
+            self._entries[key] = value
+        return value
+
+    def put(self, key, value, size):
+        self.discard(key)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, old_size) = self._entries.popitem(last=False)
+            self.size -= old_size
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def discard(self, key):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+
+
+def _memory_size(url, response):
+    """Roughly how much memory an entry takes up"""
+    return len(url) + len(response.content or '') + 100
+
+
+class CachedResponse:
+    def __init__(self, content, etag, body_hash):
+        self.content = content
+        self.etag = etag
+        self.hash = body_hash
+
+
+class ResponseCache:
+    """Caches response bodies by URL.
+
+    Lookups go to an in-process LRU first, then to MongoDB. In MongoDB the
+    web_cache collection maps a URL to the hash of its body and its ETag, and
+    web_cache_bodies holds each distinct body once, compressed, keyed by
+    hash. Many Launchpad URLs return the same body, so this is a lot smaller
+    than storing a body per URL.
+
+    Entries that haven't been fetched or revalidated for max_age seconds are
+    evicted by evict(), as are the least recently fetched entries once the
+    stored bodies take up more than max_bytes.
+
+    A URL can also be stored without its body, when the caller keeps what it
+    needs from the body somewhere else. Only the ETag and the hash of the
+    body are kept, so a 304 can still be recognised, and get() returns an
+    entry with content None.
+    """
+    def __init__(self, db, memory_bytes=32 * 1024 * 1024,
+                 max_bytes=512 * 1024 * 1024, max_age=14 * 24 * 60 * 60):
+        self.index = db['web_cache']
+        self.bodies = db['web_cache_bodies']
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._memory = MemoryLRU(memory_bytes)
+        self._lock = threading.Lock()
+        # URLs that have been revalidated with a 304 since the last evict().
+        # We record the fetch time of these in one go rather than write to
+        # the database for every 304.
+        self._touched = set()
+        self.counters = {
+            'memory_hits': 0,
+            'store_hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'duplicate_bodies': 0,
+            'revalidated': 0,
+            'evictions': 0,
+        }
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def get(self, url):
+        return self._lookup(url, count=True)
+
+    def _lookup(self, url, count):
+        with self._lock:
+            entry = self._memory.get(url)
+        if entry is not None:
+            if count:
+                self._count('memory_hits')
+            return entry[0]
+
+        doc = self.index.find_one({'url': url})
+        if doc is None:
+            if count:
+                self._count('misses')
+            return None
+
+        if 'hash' in doc:
+            body = self.bodies.find_one({'_id': doc['hash']})
+            if body is None:
+                if count:
+                    self._count('misses')
+                return None
+            content = zlib.decompress(body['body'])
+            response = CachedResponse(content, doc.get('etag'), doc['hash'])
+        elif doc.get('bodyless'):
+            response = CachedResponse(None, doc.get('etag'), doc.get('digest'))
+        elif 'content' in doc:
+            # Written before bodies were stored separately
+            content = doc['content']
+            if isinstance(content, unicode):
+                content = content.encode('utf-8')
+            response = CachedResponse(content,
+                                      doc.get('headers', {}).get('etag'),
+                                      None)
+        else:
+            if count:
+                self._count('misses')
+            return None
+
+        if count:
+            self._count('store_hits')
+        with self._lock:
+            self._memory.put(url, response, _memory_size(url, response))
+        return response
+
+    def put(self, url, content, etag=None, store_body=True):
+        """Store content as the response for url, or with store_body=False
+        just its ETag and hash. Returns True if it differs from what was
+        stored before."""
+        body_hash = hashlib.sha1(content).hexdigest()
+        old = self._lookup(url, count=False)
+        if (old is not None and old.hash == body_hash and old.etag == etag and
+                (old.content is None) == (not store_body)):
+            self.revalidated(url)
+            return False
+
+        if not store_body:
+            self.index.update_one(
+                {'url': url},
+                {'$set': {'digest': body_hash, 'etag': etag,
+                          'fetched': time.time(), 'bodyless': True},
+                 '$unset': {'hash': '', 'content': '', 'headers': ''}},
+                upsert=True)
+            response = CachedResponse(None, etag, body_hash)
+            with self._lock:
+                self._memory.put(url, response, _memory_size(url, response))
+            self._count('stores')
+            return old is None or old.hash != body_hash
+
+        compressed = zlib.compress(content)
+        now = time.time()
+        result = self.bodies.update_one(
+            {'_id': body_hash},
+            {'$setOnInsert': {'body': Binary(compressed),
+                              'size': len(compressed),
+                              'stored': now}},
+            upsert=True)
+        if result.upserted_id is None:
+            self._count('duplicate_bodies')
+        self.index.update_one(
+            {'url': url},
+            {'$set': {'hash': body_hash, 'etag': etag, 'fetched': now},
+             '$unset': {'content': '', 'headers': '', 'digest': '',
+                        'bodyless': ''}},
+            upsert=True)
+
+        response = CachedResponse(content, etag, body_hash)
+        with self._lock:
+            self._memory.put(url, response, _memory_size(url, response))
+        self._count('stores')
+        return old is None or old.hash != body_hash
+
+    def discard(self, url):
+        """Forget url, so the next request for it isn't conditional"""
+        self.index.delete_one({'url': url})
+        with self._lock:
+            self._memory.discard(url)
+
+    def drop_bodies(self, urls):
+        """Stop keeping the bodies of urls, keeping their ETags. Returns how
+        many entries were changed."""
+        changed = self.index.update_many(
+            {'url': {'$in': urls}, 'hash': {'$exists': True}},
+            {'$rename': {'hash': 'digest'}, '$set': {'bodyless': True}})
+        with self._lock:
+            for url in urls:
+                self._memory.discard(url)
+        return changed.modified_count
+
+    def revalidated(self, url):
+        """Record that the server told us our copy of url is still good."""
+        with self._lock:
+            self._touched.add(url)
+            self.counters['revalidated'] += 1
+
+    def save_touched(self, now=None):
+        """Store the fetch time of the entries revalidated since we last
+        did. Call before dropping the cache, or they will age as if they
+        hadn't been fetched."""
+        with self._lock:
+            touched = list(self._touched)
+            self._touched.clear()
+        if touched:
+            self.index.update_many({'url': {'$in': touched}},
+                                   {'$set': {'fetched': now or time.time()}})
+
+    def evict(self):
+        """Remove entries that are too old, then the least recently fetched
+        entries until the stored bodies fit in max_bytes. Returns the number
+        of URLs evicted."""
+        now = time.time()
+        self.save_touched(now)
+
+        # Entries from before we recorded fetch times start ageing now
+        self.index.update_many({'fetched': {'$exists': False}},
+                               {'$set': {'fetched': now}})
+        evicted = self.index.delete_many(
+            {'fetched': {'$lt': now - self.max_age}}).deleted_count
+        self._collect_garbage()
+
+        total = self._stored_bytes()
+        if total > self.max_bytes:
+            sizes = dict((b['_id'], b['size']) for b in
+                         self.bodies.find({}, {'size': True}))
+            referenced = {}
+            for doc in self.index.find({'hash': {'$exists': True}},
+                                       {'hash': True}):
+                referenced[doc['hash']] = referenced.get(doc['hash'], 0) + 1
+            oldest_first = self.index.find(
+                {'hash': {'$exists': True}},
+                {'url': True, 'hash': True}).sort('fetched', 1)
+            doomed = []
+            for doc in oldest_first:
+                if total <= self.max_bytes:
+                    break
+                doomed.append(doc['_id'])
+                referenced[doc['hash']] -= 1
+                if referenced[doc['hash']] == 0:
+                    total -= sizes.get(doc['hash'], 0)
+            if doomed:
+                evicted += self.index.delete_many(
+                    {'_id': {'$in': doomed}}).deleted_count
+                self._collect_garbage()
+
+        if evicted:
+            with self._lock:
+                self._memory.clear()
+        self._count('evictions', evicted)
+        return evicted
+
+    def _stored_bytes(self):
+        result = list(self.bodies.aggregate(
+            [{'$group': {'_id': None, 'size': {'$sum': '$size'}}}]))
+        if result:
+            return result[0]['size']
+        return 0
+
+    def _collect_garbage(self):
+        """Delete bodies that no URL refers to any more"""
+        referenced = self.index.distinct('hash')
+        self.bodies.delete_many({'_id': {'$nin': referenced}})
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['memory_evictions'] = self._memory.evictions
+            stats['memory_bytes'] = self._memory.size
+        stats['urls'] = self.index.count()
+        stats['bodies'] = self.bodies.count()
+        stats['stored_bytes'] = self._stored_bytes()
+        return stats
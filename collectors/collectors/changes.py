@@ -0,0 +1,88 @@
+import threading
+import time
+
+import pymongo
+from pymongo import ReturnDocument
+
+
+class ChangeLog:
+    """A sequenced log of changes to the collections the web UI shows.
+
+    Each event in the change_log collection records the collection, the field
+    that identifies the document, the document's value for that field and
+    whether it was an 'upsert' or a 'delete'. Events are numbered from a
+    counter in the counters collection, so a consumer that has seen every
+    change up to seq can ask for the rest with since(seq).
+
+    Sequence numbers are reserved with $inc before the events are stored, so
+    when more than one process appends, an event can be stored before one
+    with a lower number. since() stops at the first event that is missing,
+    unless the one after it is more than gap seconds old, in which case the
+    process that numbered it has given up. Events older than max_age are
+    deleted by trim().
+    """
+    def __init__(self, db, max_age=7 * 24 * 60 * 60, gap=60):
+        self.events = db['change_log']
+        self.counters = db['counters']
+        self.max_age = max_age
+        self.gap = gap
+        self._lock = threading.Lock()
+        self.events.create_index('seq', unique=True)
+
+    def append(self, events):
+        """Store events, a list of (collection, field, key, op) tuples.
+        Returns the sequence number of the last event stored."""
+        if not events:
+            return self.latest()
+        now = time.time()
+        with self._lock:
+            counter = self.counters.find_one_and_update(
+                {'_id': 'change_log'}, {'$inc': {'seq': len(events)}},
+                upsert=True, return_document=ReturnDocument.AFTER)
+            last = counter['seq']
+            first = last - len(events) + 1
+            self.events.insert_many([
+                {'seq': first + i, 'collection': collection, 'field': field,
+                 'key': key, 'op': op, 'time': now}
+                for i, (collection, field, key, op) in enumerate(events)])
+        return last
+
+    def latest(self):
+        counter = self.counters.find_one({'_id': 'change_log'})
+        return counter['seq'] if counter else 0
+
+    def since(self, seq, limit=1000):
+        """Events after seq, oldest first, up to the first one that hasn't
+        been stored yet. Returns (events, complete), where complete is False
+        if events after seq have already been trimmed, in which case the
+        consumer should reload everything."""
+        oldest = self.events.find_one({}, sort=[('seq', pymongo.ASCENDING)])
+        if oldest is None:
+            complete = seq >= self.latest()
+        else:
+            complete = oldest['seq'] <= seq + 1
+        stale = time.time() - self.gap
+        events = []
+        for event in (self.events.find({'seq': {'$gt': seq}}, {'_id': False})
+                      .sort('seq', pymongo.ASCENDING).limit(limit)):
+            if event['seq'] != seq + 1 and event['time'] > stale:
+                break
+            events.append(event)
+            seq = event['seq']
+        return events, complete
+
+    def reset(self):
+        """Forget every event and move the sequence number on, so every
+        consumer is told to reload everything. Returns the new sequence
+        number."""
+        with self._lock:
+            self.events.delete_many({})
+            counter = self.counters.find_one_and_update(
+                {'_id': 'change_log'}, {'$inc': {'seq': 1}},
+                upsert=True, return_document=ReturnDocument.AFTER)
+        return counter['seq']
+
+    def trim(self):
+        """Delete events older than max_age. Returns how many were deleted."""
+        cutoff = time.time() - self.max_age
+        return self.events.delete_many({'time': {'$lt': cutoff}}).deleted_count
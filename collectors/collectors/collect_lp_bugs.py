@@ -1,159 +1,609 @@
 #!/usr/bin/python
 
-import json
-import pymongo
 import os
-import re
-import copy
 import time
+import datetime
+import functools
+import itertools
+import metrics
+import multiprocessing
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from normalize import MILESTONE_LINK_RE, TaskNormalizer, on_project
+import rollups
+import snapshots
+import storage
 from utils import (
     CollectorHelpers,
-    copy_fields,
     MessageBroadcaster,
+    LaunchpadError,
+    StageTimer,
+    chunks,
+    after_fork,
+    db,
+    get_cache,
+    get_change_log,
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_PAGE_SIZE,
 )
 import requests
+from bson import ObjectId
 
 
 BASE_DIR = os.path.dirname(__file__)
-client = pymongo.MongoClient()
-db = client['juju_team_status']
 
+LP_API = 'https://api.launchpad.net/1.0/'
 
-def get_bugs(ch):
-    project_name = 'juju-core'
-    project_url = 'https://api.launchpad.net/1.0/' + project_name
-    project = ch.lp_get(db['projects'], project_url)[0]
+# Launchpad projects to collect bugs from, if settings.yaml doesn't list any
+DEFAULT_PROJECTS = ['juju-core']
 
-    content = ch.get_url(project['active_milestones_collection_link'])[0]
-    active_milestones = json.loads(content)['entries']
+# Number of bugs to fetch from Launchpad at the same time
+DEFAULT_WORKERS = 8
+
+# Bugs with a task in one of these states, on an active milestone, are the
+# ones we collect
+SEARCH_STATUSES = ['New', 'Incomplete', 'Opinion', 'Confirmed', 'Triaged',
+                   'In Progress']
+
+# Fields of bugs_filtered that are rewritten every poll. Changing these alone
+# doesn't count as a change to the bug.
+VOLATILE_FIELDS = ('update_time',)
+
+# Seconds between full syncs. In between, only bugs that Launchpad reports
+# as modified since the last sync are fetched.
+DEFAULT_FULL_SYNC_INTERVAL = 24 * 60 * 60
+
+# Launchpad modification times and our clock don't agree exactly, so each
+# incremental sync looks back a little further than the last one started.
+SYNC_OVERLAP = datetime.timedelta(minutes=10)
+
+# A run that didn't finish is carried on from its checkpoint if it started
+# less than this many seconds ago
+CHECKPOINT_MAX_AGE = 6 * 60 * 60
+
+# Times a run is carried on from its checkpoint after a connection error
+# before giving up until the next poll
+MAX_RESTARTS = 3
+
+# Seconds a poll or refresh may hold the right to write a project's bugs
+# before others assume it has died, see writing_bugs()
+WRITE_LEASE = 60
+
+
+def bug_id(bug):
+    """The bug number of a searchTasks entry"""
+    return int(bug['bug_link'].rstrip('/').rsplit('/', 1)[1])
+
+
+def fetch_bug(ch, item):
+    """Fetch a bug and its tasks. item is (search page URL, bug). Returns
+    (page URL, bug ID, (bug, bug_info, tasks)), with None in place of the
+    last if the bug can't be used."""
+    page_url, bug = item
+    return page_url, bug_id(bug), _fetch_bug(ch, bug)
+
+
+def _fetch_bug(ch, bug):
+    bug_info, status_code = ch.lp_get(db['bugs'], bug['bug_link'])
+
+    if status_code == 304:
+        #continue  # Nothing changed, so don't update
+        pass
+    elif status_code >= 400:
+        print "Error fetching bug - ignoring", bug['bug_link']
+        return None
+
+    try:
+        tasks = list(ch.lp_collection(bug_info['bug_tasks_collection_link']))
+    except LaunchpadError as e:
+        print "Unable to handle bug task", e
+        return None
+    return bug, bug_info, tasks
+
+
+def project_bug(project_name, web_link):
+    """The key of a bug in bugs_filtered. A bug can have tasks in more than
+    one of the projects we collect, and gets a document for each."""
+    return project_name + ' ' + web_link
+
+
+def get_bugs(ch, project_name=DEFAULT_PROJECTS[0], workers=DEFAULT_WORKERS,
+             batch_size=DEFAULT_BATCH_SIZE, full=False,
+             full_sync_interval=DEFAULT_FULL_SYNC_INTERVAL):
+    timer = StageTimer('lp_bugs')
+    project_url = LP_API + project_name
+    with timer.stage('milestones'):
+        project = ch.lp_get(db['projects'], project_url)[0]
+
+        active_milestones = list(ch.lp_collection(
+            project['active_milestones_collection_link']))
 
     milestones_unsorted = [m['self_link'] for m in active_milestones]
-    status = ['New', 'Incomplete', 'Opinion', 'Confirmed', 'Triaged',
-              'In Progress']
     milestones = []
     for link in milestones_unsorted:
-        s = re.search(r'\+milestone/(.*)$', link)
+        s = MILESTONE_LINK_RE.search(link)
         milestones.append(s.group(1))
     milestones = sorted(milestones)
 
-    with ch.db_entry(db['projects_meta'], {'k': 'list'}) as pl:
-        pl['k'] = 'list'
-        pl['v'] = [project_url]
-
-    with ch.db_entry(db['projects_meta'], {'k': 'details'}) as meta:
+    with ch.db_entry(db['projects_meta'],
+                     {'k': 'details', 'url': project_url}) as meta:
         meta['k'] = 'details'
         meta['url'] = project_url
+        meta['name'] = project_name
         meta['milestones'] = milestones
 
-    # Create an array 1 larger than the number of milestones, each entry
-    # containing a dictionary containing the milestone name. The last entry
-    # has the milestone name set to an empty string. We use this as a template
-    # to fill in bug tasks in milestone order. Tasks that aren't targeted to
-    # a milestone, or targeted to an inactive milestone, are just appended to
-    # the end of the list.
-    tasks_template = []
-    milestone_to_index = {}
-    mi = 0
-    for m in milestones:
-        milestone_to_index[m] = mi
-        mi += 1
-        tasks_template.append({'milestone': m})
+    # Works out which milestone slot each bug task goes in
+    normalizer = TaskNormalizer(project_name, milestones)
 
     # TODO: filter out bugs we don't care about, not start from scratch
     # db['bugs_filtered'].drop()
 
     update_time = time.time()
+    sync_start = datetime.datetime.utcnow()
+
+    # A full sync fetches every bug in the search results. Otherwise we only
+    # fetch the bugs Launchpad says were modified since the last sync and
+    # bugs we haven't seen before. Which milestone a task is stored against
+    # depends on the list of milestones, so if that changes, do a full sync.
+    sync = db['sync_state'].find_one({'name': project_url}) or {}
+    stored_ids = set(db['bugs_filtered'].distinct('id',
+                                                  {'project': project_name}))
+    full = (full or ch.very_cached or
+            'modified_since' not in sync or
+            sync.get('milestones') != milestones or
+            update_time - sync.get('last_full', 0) > full_sync_interval)
+
+    # A run that was cut short saved the search page it had got to and the
+    # bugs it had stored. Carry on from there, as the same run.
+    checkpoint = sync.get('checkpoint')
+    if (checkpoint and checkpoint['milestones'] == milestones and
+            update_time - checkpoint['update_time'] < CHECKPOINT_MAX_AGE and
+            (checkpoint['full'] or not full)):
+        update_time = checkpoint['update_time']
+        sync_start = checkpoint['sync_start']
+        full = checkpoint['full']
+        done_ids = set(checkpoint['done'])
+        search_url = checkpoint['page']
+        print project_name + ":", "Resuming from", search_url, \
+            "with {} bugs done".format(len(done_ids))
+    else:
+        checkpoint = None
+        done_ids = set()
+        search_url = ch.search_url(project_url, {
+            'milestones': milestones, 'status': SEARCH_STATUSES})
+        db['sync_state'].update_one(
+            {'name': project_url},
+            {'$set': {'checkpoint': {
+                'update_time': update_time, 'sync_start': sync_start,
+                'full': full, 'milestones': milestones,
+                'page': search_url, 'done': []}}},
+            upsert=True)
+
+    # Bug counts are kept up to date as bugs change. They are counted from
+    # scratch the first time and on every full sync in case they drift.
+    rollup = rollups.Rollup(db['bug_rollups'])
+    if full or not sync.get('rollups'):
+        with timer.stage('recount'), writing_bugs(project_name):
+            rollups.recount(db, project_name)
 
-    bugs = json.loads(
-        ch.lp_search(project_url, {
-            'milestones': milestones, 'status': status}))['entries']
-
-    for bug in bugs:
-        bug_info, status_code = ch.lp_get(db['bugs'], bug['bug_link'])
-
-        if status_code == 304:
-            #continue  # Nothing changed, so don't update
-            pass
-        elif status_code >= 400:
-            print "Error fetching bug - ignoring", bug['bug_link']
-            continue
-
-        content, status_code = ch.get_url_lp_oauth(bug_info['bug_tasks_collection_link'])
-        if status_code >= 400:
-            print "Unable to handle bug task", content, status
-            continue
-        tasks = json.loads(content)
-        for task in tasks['entries']:
-            ch.db_entry(db['bug_tasks'], {'self_link': task['self_link']}, task)
-
-        # Now create a database entry containing only the information we need
-        with ch.db_entry(db['bugs_filtered'], {'web_link': bug_info['web_link']}) as b:
-            copy_fields(bug_info, b, ['web_link', 'tags', 'title', 'private', 'id'])
-            b['target'] = bug['bug_target_display_name']
-            b['tasks'] = copy.deepcopy(tasks_template)
-            b['update_time'] = update_time
-
-            for task in tasks['entries']:
-                #if not task['target_link'].endswith('/' + project_name):
-                #    print task['target_link']
-                #    print task['bug_target_display_name']
-                #    continue
-                if not task['bug_target_display_name'].startswith(project_name):
-                    print task['target_link']
-                    print task['bug_target_display_name']
+    modified_links = set()
+    if not full:
+        # modified_since is different every poll, so there is no point
+        # caching the pages of this search
+        with timer.stage('search modified'):
+            modified_links = set(b['bug_link'] for b in ch.lp_search(
+                project_url, {
+                    'milestones': milestones, 'status': SEARCH_STATUSES,
+                    'modified_since': sync['modified_since']},
+                cached=False))
+
+    # Search results are streamed a page at a time. We remember the ID of
+    # every bug in them so we can tell which stored bugs have gone away, but
+    # only once we have been through every page.
+    seen_ids = set()
+    counts = {'fetch': 0, 'searched': False}
+
+    def bugs_to_fetch():
+        for page_url, bugs in ch.lp_pages(search_url):
+            for bug in bugs:
+                seen_ids.add(bug_id(bug))
+                if bug_id(bug) in done_ids:
                     continue
-                t = {}
-                copy_fields(task, t, ['status', 'importance', 'assignee_link',
-                                      'milestone_link', 'target_link'])
-
-                if task.get('milestone_link'):
-                    s = re.search(r'\+milestone/(.*)$', task['milestone_link'])
-                    if s:
-                        t['milestone'] = s.group(1)
-                    else:
-                        print "Couldn't parse milestone_link", task['milestone_link']
-                        t['milestone'] = ""
-                elif task.get('target_link'):
-                    s = re.search(project_name + '/(.*)$', task['target_link'])
-                    if s:
-                        t['milestone'] = s.group(1)
+                if (full or bug['bug_link'] in modified_links or
+                        bug_id(bug) not in stored_ids):
+                    counts['fetch'] += 1
+                    yield page_url, bug
+        counts['searched'] = True
+
+    # Fetching a bug and its tasks doesn't depend on any other bug, so do it
+    # in a pool, a batch at a time. The search is read from this thread, so
+    # an error fetching a page of it is raised here rather than lost in the
+    # pool. Results come back in search order and are stored from this
+    # thread, so the documents we write are the same as a serial run.
+    pool = None
+    fetch = functools.partial(fetch_bug, ch)
+    if workers > 1:
+        pool = ThreadPool(workers)
+
+    # Store bugs a batch at a time: the documents we are about to update are
+    # read with one query per collection, and written back in bulk.
+    try:
+        todo = timer.iterate('search', bugs_to_fetch())
+        with ch.db_batch(db['bug_tasks'], 'self_link', batch_size) as bug_tasks, \
+                ch.db_batch(db['bugs_filtered'], 'project_bug', batch_size,
+                            volatile=VOLATILE_FIELDS) as bugs_filtered:
+            for batch in chunks(todo, batch_size):
+                with timer.stage('fetch bugs'):
+                    if pool is not None:
+                        chunk = pool.map(fetch, batch)
                     else:
-                        t['milestone'] = ""
-                else:
-                    t['milestone'] = ""
-
-                if t['milestone'] not in milestones:
-                    # find something close, if we can
-                    t_parts = t['milestone'].split('.')
-                    for m in milestones:
-                        m_parts = m.split('.')
-                        if m_parts[0] == t_parts[0] and m_parts[1] == t_parts[1]:
-                            # Match major.minor. We have an extra number often, but this close is fine.
-                            t['milestone'] = m
-
-                if t['milestone'] in milestones:
-                    b['tasks'][milestone_to_index[t['milestone']]] = t
-                elif len(b['tasks']) == len(milestones):
-                    # At this point we still may have some tasks targeted to
-                    # milestones that don't exist. We keep them around, but
-                    # they mostly just mess up the data :-| Only have one extra
-                    # task so we limit extra junk.
-                    b['tasks'].append(t)
-
-    # Delete any bug that we didn't just update
-    db['bugs_filtered'].delete_many({'update_time': {'$ne': update_time}})
-
-
-def collect(very_cached=False):
+                        chunk = map(fetch, batch)
+                page_url = chunk[-1][0]
+                ids = [i for _, i, r in chunk if r is not None]
+                chunk = [r for _, _, r in chunk if r is not None]
+                with timer.stage('store bugs'), writing_bugs(project_name):
+                    bug_tasks.prefetch(task['self_link']
+                                       for _, _, tasks in chunk
+                                       for task in tasks)
+                    bugs_filtered.prefetch(
+                        project_bug(project_name, bug_info['web_link'])
+                        for _, bug_info, _ in chunk)
+                    for bug, bug_info, tasks in chunk:
+                        store_bug(bug_tasks, bugs_filtered, normalizer,
+                                  bug, bug_info, tasks, update_time, rollup)
+                    bug_tasks.flush()
+                    bugs_filtered.flush()
+                    rollup.flush()
+                    db['sync_state'].update_one(
+                        {'name': project_url},
+                        {'$set': {'checkpoint.page': page_url},
+                         '$addToSet': {'checkpoint.done': {'$each': ids}}})
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    # Delete any bug that is no longer in the search results. Results can
+    # move between pages while a run is stopped, so a run that was carried
+    # on from a checkpoint hasn't necessarily seen every bug, and leaves this
+    # to the next run. Nor do we delete anything unless every page of the
+    # search was read.
+    with timer.stage('delete stale'):
+        stale = set()
+        if counts['searched'] and not checkpoint:
+            stale = stored_ids - seen_ids
+        remove_bugs(ch, project_name, stale, rollup)
+
+    with timer.stage('history'):
+        rollups.record_history(db, project_name, update_time, milestones)
+
+    state = {
+        'modified_since': (sync_start - SYNC_OVERLAP).isoformat(),
+        'milestones': milestones,
+        'rollups': True,
+    }
+    if full:
+        state['last_full'] = update_time
+    db['sync_state'].update_one({'name': project_url},
+                                {'$set': state, '$unset': {'checkpoint': ''}},
+                                upsert=True)
+
+    print project_name + ":", "Got {} bugs, fetched {} ({} sync), deleted {}, in {:.2f}s using {} workers".format(
+        len(seen_ids), counts['fetch'], 'full' if full else 'incremental',
+        len(stale), time.time() - update_time, workers)
+    timer.report()
+
+
+@contextmanager
+def writing_bugs(project_name):
+    """Hold the right to write a project's stored bugs and their rollups
+    for the with block. Polls and refreshes of a project run in different
+    threads and processes, and each works out the change to the rollups from
+    the version of a bug it read, so two writing the same bug at once would
+    both take its old counts off. The right is a lease in the project's
+    sync_state document, which others take over if it isn't given back
+    within WRITE_LEASE seconds."""
+    url = LP_API + project_name
+    owner = ObjectId()
+    db['sync_state'].update_one({'name': url}, {'$setOnInsert': {'name': url}},
+                                upsert=True)
+    start = time.time()
+    while True:
+        now = time.time()
+        if db['sync_state'].update_one(
+                {'name': url, '$or': [{'writer': None},
+                                      {'writer.expires': {'$lt': now}}]},
+                {'$set': {'writer': {'owner': owner,
+                                     'expires': now + WRITE_LEASE}}}
+                ).matched_count:
+            break
+        time.sleep(0.1)
+    metrics.observe('bug_write_wait_seconds', time.time() - start,
+                    project=project_name)
+    try:
+        yield
+    finally:
+        db['sync_state'].update_one({'name': url, 'writer.owner': owner},
+                                    {'$unset': {'writer': ''}})
+
+
+def store_bug(bug_tasks, bugs_filtered, normalizer, bug, bug_info, tasks,
+              update_time, rollup=None):
+    for task in tasks:
+        bug_tasks.upsert(task['self_link'], storage.project('bug_tasks', task))
+
+    # Now create a database entry containing only the information we need
+    key = project_bug(normalizer.project_name, bug_info['web_link'])
+    with bugs_filtered.entry(key) as b:
+        old = {'project': b.get('project'), 'tasks': b.get('tasks', [])}
+        b.update(normalizer.bug(bug, bug_info, tasks, update_time))
+        b['project_bug'] = key
+        if rollup is not None:
+            rollup.changed(old, b)
+
+
+def remove_bugs(ch, project_name, ids, rollup):
+    """Delete the bugs_filtered documents of a project for the bug IDs in
+    ids"""
+    if not ids:
+        return
+    query = {'project': project_name, 'id': {'$in': list(ids)}}
+    with writing_bugs(project_name):
+        docs = list(db['bugs_filtered'].find(
+            query, {'project_bug': True, 'project': True, 'tasks': True}))
+        db['bugs_filtered'].delete_many(query)
+        for doc in docs:
+            rollup.remove(doc)
+        rollup.flush()
+    ch.message.updated(len(docs))
+    for doc in docs:
+        ch.message.changed('bugs_filtered', 'project_bug',
+                           doc['project_bug'], 'delete')
+
+
+def search_task(tasks, project_name, milestones):
+    """The first of a bug's tasks that a search of project_name would
+    return it for, or None"""
+    for task in tasks:
+        m = MILESTONE_LINK_RE.search(task.get('milestone_link') or '')
+        if (on_project(task, project_name) and
+                task.get('status') in SEARCH_STATUSES and
+                m and m.group(1) in milestones):
+            return task
+    return None
+
+
+def project_target(tasks, project_name):
+    """The target name of a bug's task on the project itself, which is the
+    task a search of the project returns"""
+    for task in tasks:
+        if task.get('target_link') == LP_API + project_name:
+            return task['bug_target_display_name']
+    return project_name
+
+
+def refresh_bugs(ch, project_name, entries, workers=DEFAULT_WORKERS,
+                 batch_size=DEFAULT_BATCH_SIZE):
+    """Fetch bugs again and update what we store for them in project_name,
+    between polls. entries maps the ID of each bug to its searchTasks entry,
+    or to None if we haven't searched for it. Bugs that a search of the
+    project wouldn't return any more are removed, as the next poll would.
+    Bugs that can't be fetched are left as they are."""
+    meta = db['projects_meta'].find_one({'k': 'details',
+                                         'url': LP_API + project_name})
+    if meta is None or not entries:
+        return
+    ids = sorted(entries)
+    milestones = meta['milestones']
+    normalizer = TaskNormalizer(project_name, milestones)
+    update_time = time.time()
+    rollup = rollups.Rollup(db['bug_rollups'])
+    gone = []
+
+    # Without a search entry, the target is what the last poll stored, from
+    # its search entry, or for a new bug that of the project's own task
+    targets = dict((d['id'], d.get('target')) for d in db['bugs_filtered'].find(
+        {'project': project_name, 'id': {'$in': ids}},
+        {'id': True, 'target': True}))
+
+    def fetch(i):
+        return _fetch_bug(ch, {'bug_link': LP_API + 'bugs/' + str(i)})
+
+    pool = ThreadPool(max(1, min(workers, len(ids))))
+    try:
+        results = pool.map(fetch, ids)
+    finally:
+        pool.terminate()
+
+    # The stored bugs are read and written while no poll is writing them
+    with writing_bugs(project_name), \
+            ch.db_batch(db['bug_tasks'], 'self_link', batch_size) as bug_tasks, \
+            ch.db_batch(db['bugs_filtered'], 'project_bug', batch_size,
+                        volatile=VOLATILE_FIELDS) as bugs_filtered:
+        for i, result in itertools.izip(ids, results):
+            if result is None:
+                print "Couldn't fetch bug", i, "- leaving it as it is"
+                continue
+            _, bug_info, tasks = result
+            if search_task(tasks, project_name, milestones) is None:
+                gone.append(i)
+                continue
+            entry = entries[i] or {'bug_target_display_name':
+                                   targets.get(i) or
+                                   project_target(tasks, project_name)}
+            store_bug(bug_tasks, bugs_filtered, normalizer, entry,
+                      bug_info, tasks, update_time, rollup)
+        bug_tasks.flush()
+        bugs_filtered.flush()
+        rollup.flush()
+    remove_bugs(ch, project_name, gone, rollup)
+
+
+def milestone_bugs(ch, project_name, milestone):
+    """{bug ID: searchTasks entry} for the bugs a search of one milestone
+    returns, and {bug ID: None} for the bugs we have stored against it,
+    which may have moved since"""
+    entries = dict((i, None) for i in db['bugs_filtered'].distinct('id', {
+        'project': project_name,
+        'tasks': {'$elemMatch': {'milestone': milestone,
+                                 'status': {'$exists': True}}}}))
+    for bug in ch.lp_search(LP_API + project_name, {
+            'milestones': [milestone], 'status': SEARCH_STATUSES}):
+        entries[bug_id(bug)] = bug
+    return entries
+
+
+def refresh(bug=None, milestone=None, projects=DEFAULT_PROJECTS,
+            workers=DEFAULT_WORKERS, batch_size=DEFAULT_BATCH_SIZE,
+            page_size=DEFAULT_PAGE_SIZE):
+    """Refresh one bug, or the bugs in one milestone, in each of projects,
+    without waiting for the next poll. Returns the number of changes."""
+    with MessageBroadcaster() as message:
+        ch = CollectorHelpers(message, page_size=page_size)
+        for project_name in projects:
+            if bug is not None:
+                entries = {bug: None}
+            else:
+                entries = milestone_bugs(ch, project_name, milestone)
+            refresh_bugs(ch, project_name, entries, workers, batch_size)
+        changes = message.changes
+
+    # The web server has been pinged by now. Snapshots are for clients that
+    # are starting up, so they can wait a moment.
+    if changes:
+        snapshots.build(db, get_change_log().latest())
+    return changes
+
+
+def collect_project(project_name, very_cached=False, workers=DEFAULT_WORKERS,
+                    batch_size=DEFAULT_BATCH_SIZE, full=False,
+                    full_sync_interval=DEFAULT_FULL_SYNC_INTERVAL,
+                    page_size=DEFAULT_PAGE_SIZE):
     with MessageBroadcaster() as message:
-        ch = CollectorHelpers(message, very_cached)
+        ch = CollectorHelpers(message, very_cached, page_size=page_size)
+        restarts = 0
         while True:
             try:
-                get_bugs(ch)
-                return
-            except requests.exceptions.ConnectionError:
+                get_bugs(ch, project_name, workers, batch_size, full,
+                         full_sync_interval)
+                return message.changes
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                # Each request has already been retried, so Launchpad is
+                # having a bad time. Carry on from the checkpoint in a
+                # while, or leave it to the next poll.
+                restarts += 1
+                if restarts > MAX_RESTARTS:
+                    raise
+                print project_name + ":", e, "- resuming in 10s"
                 time.sleep(10)
 
 
+def _collect_project(args):
+    return collect_project(*args)
+
+
+def _collect_project_worker(args):
+    """_collect_project in a worker process. The fetch times of the
+    responses it revalidated are saved before the worker's cache goes, and
+    the metrics it recorded are returned with the number of changes, for the
+    parent to merge into its own."""
+    try:
+        changes = collect_project(*args)
+    finally:
+        get_cache().save_touched()
+    return changes, metrics.registry.take()
+
+
+def _remove_bugs_matching(message, query):
+    for doc in db['bugs_filtered'].find(query, {'web_link': True,
+                                                'project_bug': True}):
+        if 'project_bug' in doc:
+            message.changed('bugs_filtered', 'project_bug',
+                            doc['project_bug'], 'delete')
+        else:
+            message.changed('bugs_filtered', 'web_link', doc['web_link'],
+                            'delete')
+        message.updated()
+    db['bugs_filtered'].delete_many(query)
+
+
+def merge_projects(project_names):
+    """Record the projects we collected in projects_meta. If they aren't
+    the ones we collected last time, remove what we have stored for projects
+    we no longer collect."""
+    urls = [LP_API + p for p in project_names]
+    with MessageBroadcaster() as message:
+        ch = CollectorHelpers(message)
+        previous = db['projects_meta'].find_one({'k': 'list'}, {'v': True})
+        if previous is None or previous.get('v') != urls:
+            removed = db['projects_meta'].delete_many(
+                {'k': 'details', 'url': {'$nin': urls}}).deleted_count
+            message.updated(removed)
+            _remove_bugs_matching(message,
+                                  {'project': {'$nin': project_names}})
+
+        # The list is written last, so if we stop before this we try again
+        with ch.db_entry(db['projects_meta'], {'k': 'list'}) as pl:
+            pl['k'] = 'list'
+            pl['v'] = urls
+        return message.changes
+
+
+def remove_legacy_bugs():
+    """Remove the bugs stored before bugs were collected from more than one
+    project, which are keyed on web_link alone. Their projects' next polls
+    store them again. Finding them scans the whole of bugs_filtered, so
+    this is only done at start up. Returns the number of changes."""
+    with MessageBroadcaster() as message:
+        _remove_bugs_matching(message, {'project_bug': {'$exists': False}})
+        return message.changes
+
+
+def collect(very_cached=False, workers=DEFAULT_WORKERS,
+            batch_size=DEFAULT_BATCH_SIZE, full=False,
+            full_sync_interval=DEFAULT_FULL_SYNC_INTERVAL,
+            projects=DEFAULT_PROJECTS, processes=None,
+            page_size=DEFAULT_PAGE_SIZE):
+    """Collect bugs from each project. With more than one project, each is
+    collected in its own worker process, up to processes at a time (one per
+    project by default). Workers connect to the database themselves and
+    share cached responses through it."""
+    args = [(p, very_cached, workers, batch_size, full, full_sync_interval,
+             page_size) for p in projects]
+    processes = min(processes or len(projects), len(projects))
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, after_fork)
+        try:
+            results = pool.map(_collect_project_worker, args, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        for _, taken in results:
+            metrics.registry.merge(taken)
+        changes = sum(c for c, _ in results)
+    else:
+        changes = sum(_collect_project(a) for a in args)
+    changes += merge_projects(projects)
+
+    # Render what the web UI loads on start up. Open dashboards follow the
+    # change log, so this doesn't hold up the ping. The sequence number is
+    # read first, so the snapshots are at least as new as it says. Snapshots
+    # are also brought up to date once other collectors, such as LeanKit's,
+    # have logged changes since, or clients loading them would be told to
+    # reload once the log has moved on too far.
+    seq = get_change_log().latest()
+    stored = db['snapshots'].find_one({'_id': 'bugs'}, {'seq': True})
+    if changes or stored is None or stored.get('seq') != seq:
+        written = snapshots.build(db, seq)
+        print "Rebuilt {} snapshots".format(written)
+    return changes
+
+
 if __name__ == '__main__':
-    collect(True)
+    import sys
+
+    if '--full' in sys.argv:
+        # Resync everything from Launchpad now
+        collect(full=True)
+    else:
+        collect(True)
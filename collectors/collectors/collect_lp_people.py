@@ -1,50 +1,124 @@
 #!/usr/bin/python
 
 import os
-import json
 import pymongo
+from multiprocessing.pool import ThreadPool
 from utils import (
     CollectorHelpers,
     MessageBroadcaster,
-    DBEntry,
+    db,
+    DEFAULT_PAGE_SIZE,
 )
 import time
 import requests
 
 BASE_DIR = os.path.dirname(__file__)
-client = pymongo.MongoClient()
-db = client['juju_team_status']
+
+DEFAULT_WORKERS = 8
 
 
 def get_lp_team_members(ch, team):
     lp_url = 'https://api.launchpad.net/1.0/~'
-    content, status_code = ch.get_url_lp_oauth(lp_url + team + '/members')
-    return json.loads(content)['entries']
+    return list(ch.lp_collection(lp_url + team + '/members'))
+
+
+def expand_teams(ch, team_names, workers=DEFAULT_WORKERS):
+    """Fetch the members of each team and, level by level, of every team
+    that is a member of one of them. Each team is fetched once, however many
+    teams it belongs to. Returns {team name: list of member entries}."""
+    members = {}
+    pool = ThreadPool(workers)
+    try:
+        level = list(set(team_names))
+        while level:
+            results = pool.map(lambda team: get_lp_team_members(ch, team),
+                               level)
+            members.update(zip(level, results))
+            level = list(set(m['name'] for entries in results
+                             for m in entries
+                             if m.get('is_team') and m['name'] not in members))
+    finally:
+        pool.close()
+        pool.join()
+    return members
+
+
+def flatten(members):
+    """Returns {team name: set of the people in it, directly or through
+    sub-teams}"""
+    people = {}
+    for team in members:
+        found = set()
+        seen = set([team])
+        pending = [team]
+        while pending:
+            for m in members.get(pending.pop(), []):
+                if not m.get('is_team'):
+                    found.add(m['name'])
+                elif m['name'] not in seen:
+                    seen.add(m['name'])
+                    pending.append(m['name'])
+        people[team] = found
+    return people
+
 
+def store_membership(message, people):
+    """Make lp_membership hold one {person, team} document for each person
+    in each team, so checking that someone is in a team is one indexed
+    lookup. Teams we no longer collect lose their documents."""
+    collection = db['lp_membership']
+    collection.create_index([('person', pymongo.ASCENDING),
+                             ('team', pymongo.ASCENDING)], unique=True)
+    wanted = set((person, team) for team, names in people.iteritems()
+                 for person in names)
+    stored = {}
+    for doc in collection.find():
+        stored[(doc['person'], doc['team'])] = doc['_id']
 
-def collect(team_names):
+    added = [{'person': person, 'team': team}
+             for person, team in wanted if (person, team) not in stored]
+    removed = [_id for key, _id in stored.iteritems() if key not in wanted]
+    if added:
+        collection.insert_many(added, ordered=False)
+    if removed:
+        collection.delete_many({'_id': {'$in': removed}})
+    if added or removed:
+        message.updated(len(added) + len(removed))
+
+
+def collect(team_names, workers=DEFAULT_WORKERS, page_size=DEFAULT_PAGE_SIZE):
     with MessageBroadcaster() as message:
-        ch = CollectorHelpers(message, very_cached=False)
+        ch = CollectorHelpers(message, very_cached=False, page_size=page_size)
         ch.lp_login()
 
-        # Collect team members
-        teams = {}
-        for team_name in team_names:
-            teams[team_name] = get_lp_team_members(ch, team_name)
-
-        # Extract members that we have found
-        team_member_names = {}
-        for team in teams:
-            team_member_names[team] = {'members': []}
-            for member in teams[team]:
-                team_member_names[team]['members'].append(member['name'])
-                DBEntry(None, db['lp_people'], {'name': member['name']},
-                        member)
-
-        # Save easy to use team -> members list
-        for team in teams:
-            DBEntry(None, db['lp_teams'], {'name': team},
-                    team_member_names[team])
+        # Collect team members, including the members of sub-teams. Pages
+        # that haven't changed since the last run are answered with a 304.
+        teams = expand_teams(ch, team_names, workers)
+        people = flatten(teams)
+
+        # Store each person we have found once
+        with ch.db_batch(db['lp_people'], 'name') as batch:
+            found = {}
+            for entries in teams.itervalues():
+                for member in entries:
+                    found[member['name']] = member
+            batch.prefetch(found.keys())
+            for name, member in found.iteritems():
+                batch.upsert(name, dict(member))
+
+        # Save easy to use team -> members lists. members are the direct
+        # members, including sub-teams, and people everyone in the team.
+        with ch.db_batch(db['lp_teams'], 'name') as batch:
+            batch.prefetch(teams.keys())
+            for team, entries in teams.iteritems():
+                with batch.entry(team) as t:
+                    t['name'] = team
+                    t['members'] = [m['name'] for m in entries]
+                    t['people'] = sorted(people[team])
+
+        store_membership(message, people)
+        print "{} teams, {} people".format(len(teams), len(found))
+        return message.changes
 
 
 if __name__ == '__main__':
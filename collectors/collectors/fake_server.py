@@ -0,0 +1,280 @@
+"""A local stand-in for the Launchpad and LeanKit APIs, for benchmarks.
+
+FakeServer serves synthetic but realistically shaped payloads for a project
+with a given number of bugs, and supports ETags and injected latency.
+Collectors are pointed at it by mounting a RedirectAdapter on their HTTP
+session, which sends requests for the real hosts to the fake server instead.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import json
+import re
+import threading
+import time
+import urllib
+import urlparse
+
+from requests.adapters import HTTPAdapter
+
+
+LP_API = 'https://api.launchpad.net/1.0/'
+LEANKIT_API = 'https://canonical.leankit.com/kanban/api/'
+HOSTS = ['https://api.launchpad.net/', 'https://launchpad.net/',
+         'https://canonical.leankit.com/']
+
+STATUSES = ['New', 'Incomplete', 'Opinion', 'Confirmed', 'Triaged',
+            'In Progress']
+IMPORTANCES = ['Undecided', 'Critical', 'High', 'Medium', 'Low', 'Wishlist']
+
+
+class FakeData:
+    """The data served by FakeServer. Bugs are numbered from 1 to bugs.
+    modify() changes some of them, as if someone had edited them on
+    Launchpad. Requests for a route in failing get the status it maps to."""
+    def __init__(self, project='juju-core', bugs=100, milestones=5,
+                 team_members=50, cards=None, board_id=1234):
+        self.project = project
+        self.bugs = bugs
+        self.milestones = ['1.{}.0'.format(20 + i) for i in range(milestones)]
+        self.team_members = team_members
+        self.cards = cards if cards is not None else max(1, bugs / 10)
+        self.board_id = board_id
+        self.versions = {}
+        self.modified = {}
+        self.board_version = 1
+        self.failing = {}
+
+    def modify(self, bug_ids):
+        now = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime())
+        for i in bug_ids:
+            self.versions[i] = self.versions.get(i, 0) + 1
+            self.modified[i] = now
+        self.board_version += 1
+
+    def project_doc(self):
+        return {
+            'self_link': LP_API + self.project,
+            'name': self.project,
+            'active_milestones_collection_link':
+                LP_API + self.project + '/active_milestones',
+        }
+
+    def milestone_docs(self):
+        return [{'self_link': LP_API + self.project + '/+milestone/' + m,
+                 'name': m} for m in self.milestones]
+
+    def search(self, modified_since=None):
+        ids = range(1, self.bugs + 1)
+        if modified_since:
+            ids = [i for i in ids if self.modified.get(i, '') >= modified_since]
+        return [{
+            'self_link': LP_API + self.project + '/+bug/{}'.format(i),
+            'bug_link': LP_API + 'bugs/{}'.format(i),
+            'bug_target_display_name': self.project,
+            'status': STATUSES[i % len(STATUSES)],
+        } for i in ids]
+
+    def bug(self, i):
+        return {
+            'self_link': LP_API + 'bugs/{}'.format(i),
+            'id': i,
+            'title': 'Bug {} (version {})'.format(i, self.versions.get(i, 0)),
+            'description': 'Something is broken. ' * 20,
+            'tags': ['tag{}'.format(i % 7)],
+            'private': False,
+            'web_link': 'https://bugs.launchpad.net/bugs/{}'.format(i),
+            'bug_tasks_collection_link':
+                LP_API + 'bugs/{}/bug_tasks'.format(i),
+            'date_last_updated': self.modified.get(i, '2015-01-01T00:00:00'),
+        }
+
+    def bug_tasks(self, i):
+        tasks = []
+        for n in range(1 + i % 3):
+            milestone = self.milestones[(i + n) % len(self.milestones)]
+            tasks.append({
+                'self_link': LP_API + '{}/{}/+bug/{}'.format(
+                    self.project, milestone, i),
+                'bug_link': LP_API + 'bugs/{}'.format(i),
+                'bug_target_display_name': '{} {}'.format(
+                    self.project, milestone),
+                'status': STATUSES[(i + n) % len(STATUSES)],
+                'importance': IMPORTANCES[(i + n) % len(IMPORTANCES)],
+                'assignee_link': LP_API + '~person{}'.format(
+                    (i + n) % max(1, self.team_members)),
+                'milestone_link': LP_API + self.project + '/+milestone/' +
+                milestone,
+                'target_link': LP_API + self.project + '/' + milestone,
+            })
+        return tasks
+
+    def members(self, team):
+        return [{'self_link': LP_API + '~person{}'.format(i),
+                 'name': 'person{}'.format(i),
+                 'display_name': 'Person {}'.format(i),
+                 'is_team': False}
+                for i in range(self.team_members)]
+
+    def board(self):
+        lanes = []
+        for l in range(4):
+            cards = [{'Id': c, 'Title': 'Card {}'.format(c),
+                      'AssignedUsers': [{'FullName': 'Person {}'.format(c % 5)}]}
+                     for c in range(self.cards) if c % 4 == l]
+            lanes.append({'Title': 'Lane {}'.format(l), 'Id': 100 + l,
+                          'Cards': cards})
+        return {'ReplyCode': 200, 'ReplyData': [{
+            'Title': 'Board', 'Id': self.board_id,
+            'Version': self.board_version,
+            'Lanes': lanes[1:], 'Backlog': lanes[:1]}]}
+
+    def taskboard(self, card):
+        return {'ReplyCode': 200, 'ReplyData': [{'Lanes': [
+            {'Title': title, 'Id': 200 + n, 'Cards': [
+                {'Id': card * 10 + n, 'Title': 'Task {}'.format(n),
+                 'LaneTitle': title}]}
+            for n, title in enumerate(['ToDo', 'Doing', 'Done'])]}]}
+
+
+def page(url, entries, query):
+    """Return one page of a Launchpad style collection"""
+    start = int(query.get('ws.start', ['0'])[0])
+    size = int(query.get('ws.size', ['75'])[0])
+    doc = {'entries': entries[start:start + size],
+           'total_size': len(entries), 'start': start}
+    if start + size < len(entries):
+        params = dict((k, v[0]) for k, v in query.items())
+        params['ws.start'] = start + size
+        params['ws.size'] = size
+        doc['next_collection_link'] = url + '?' + urllib.urlencode(params)
+    return doc
+
+
+class FakeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _route(self, url, query):
+        data = self.server.data
+        project = LP_API + data.project
+        if url == project and query.get('ws.op') == ['searchTasks']:
+            modified_since = query.get('modified_since', [None])[0]
+            return 'searchTasks', page(
+                url, data.search(modified_since), query)
+        if url == project:
+            return 'project', data.project_doc()
+        if url == project + '/active_milestones':
+            return 'milestones', page(url, data.milestone_docs(), query)
+        m = re.match(re.escape(LP_API) + r'bugs/(\d+)(/bug_tasks)?$', url)
+        if m:
+            i = int(m.group(1))
+            if i < 1 or i > data.bugs:
+                return 'bug', None
+            if m.group(2):
+                return 'bug_tasks', page(url, data.bug_tasks(i), query)
+            return 'bug', data.bug(i)
+        m = re.match(re.escape(LP_API) + r'~([^/]+)/members$', url)
+        if m:
+            return 'members', page(url, data.members(m.group(1)), query)
+        m = re.match(re.escape(LEANKIT_API) + r'boards/(\d+)$', url)
+        if m:
+            return 'board', data.board()
+        m = re.match(re.escape(LEANKIT_API) +
+                     r'/?v1/board/\d+/card/(\d+)/taskboard$', url)
+        if m:
+            return 'taskboard', data.taskboard(int(m.group(1)))
+        return 'unknown', None
+
+    def do_GET(self):
+        # Requests arrive as /<host>/<path>, see RedirectAdapter
+        parsed = urlparse.urlparse(self.path)
+        url = 'https:/' + parsed.path
+        query = urlparse.parse_qs(parsed.query)
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        route, doc = self._route(url, query)
+
+        if route in self.server.data.failing:
+            status, body = self.server.data.failing[route], 'Failed'
+        elif doc is None:
+            status, body = 404, 'Not found'
+        else:
+            status, body = 200, json.dumps(doc)
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if status == 200 and self.headers.get('if-none-match') == etag:
+            status, body = 304, ''
+        self.server.count(route, status)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if status != 404:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.server.count('post', 200)
+        body = 'oauth_token=fake&oauth_token_secret=fake'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, data, latency=0, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           FakeHandler)
+        self.data = data
+        self.latency = latency
+        self.counts = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/'.format(self.server_address[1])
+
+    def count(self, route, status):
+        with self._lock:
+            key = (route, status)
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def reset_counts(self):
+        with self._lock:
+            counts, self.counts = self.counts, {}
+        return counts
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class RedirectAdapter(HTTPAdapter):
+    """Sends requests for https://<host>/<path> to <target>/<host>/<path>"""
+    def __init__(self, target, **kwargs):
+        HTTPAdapter.__init__(self, **kwargs)
+        self.target = target
+
+    def send(self, request, **kwargs):
+        request.url = self.target + request.url.split('://', 1)[1]
+        return HTTPAdapter.send(self, request, **kwargs)
+
+
+def redirect(session, server):
+    """Point session at server for every host we collect from"""
+    adapter = RedirectAdapter(server.url, pool_maxsize=32)
+    for host in HOSTS:
+        session.mount(host, adapter)
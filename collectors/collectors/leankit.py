@@ -1,23 +1,38 @@
 #!/usr/bin/python
 
+import hashlib
 import json
-import pymongo
 import os
-from utils import CollectorHelpers, MessageBroadcaster
+from multiprocessing.pool import ThreadPool
+from utils import CollectorHelpers, MessageBroadcaster, db
 
 
 BASE_DIR = os.path.dirname(__file__)
-client = pymongo.MongoClient()
-db = client['juju_team_status']
 
+DEFAULT_WORKERS = 8
 
-class CardGetter:
-    def __init__(self, settings, ch):
 
-        # TODO: delete unreferenced cards, not the whole collection
-        db['cards'].drop()
+def listing_hash(lane, card):
+    """A fingerprint of how a card appears on the board. LeanKit updates the
+    task counts in the listing when a card's taskboard changes, so cards with
+    the same fingerprint as last time don't need their taskboard fetched."""
+    return hashlib.sha1(json.dumps([lane['Title'], card],
+                                   sort_keys=True)).hexdigest()
+
 
+class CardGetter:
+    """Keeps the cards collection in step with a LeanKit board.
+
+    Nothing is fetched beyond the board itself if the board version hasn't
+    changed since the last sync. Otherwise taskboards are fetched, on a pool
+    of workers, only for cards whose listing on the board has changed. Cards
+    are updated in place and only cards that have left the board are
+    deleted, so the collection is never empty while a sync is running. With
+    full=True every taskboard is fetched again."""
+    def __init__(self, settings, ch, workers=DEFAULT_WORKERS, full=False):
         self.ch = ch
+        self.workers = workers
+        self.full = full
         self.board_id = str(settings['leankit_board'])
         self.base_url = 'https://canonical.leankit.com/kanban/api/'
         self.board_url = self.base_url + 'boards/' + self.board_id
@@ -26,30 +41,95 @@ class CardGetter:
         self.auth = (settings['leankit_user'], settings['leankit_pass'])
         self.name = settings['leankit_name']
 
-    def get_cards(self):
+    def get_board(self):
+        """Returns the board, its lanes, including the backlog, and its
+        version"""
         data, status = self.ch.get_url(self.board_url, auth=self.auth)
         board = json.loads(data)
+        lanes = board['ReplyData'][0]['Lanes'] + board['ReplyData'][0]['Backlog']
+        return board, lanes, board['ReplyData'][0].get('Version')
+
+    def get_cards(self):
+        board, lanes, version = self.get_board()
 
         # Store metadata for the board against the board URL
         with self.ch.db_entry(db['cards'], {'Url': self.board_url}) as c:
+            stored_version = c.get('Version')
             c['Url'] = self.board_url
             c['Board'] = True
             c['lanes'] = {}
-            for lane in board['ReplyData'][0]['Lanes'] + board['ReplyData'][0]['Backlog']:
+            for lane in lanes:
                 c['lanes'][lane['Title']] = lane['Id']
 
-        for lane in board['ReplyData'][0]['Lanes'] + board['ReplyData'][0]['Backlog']:
+        if (not self.full and version is not None and
+                version == stored_version):
+            print "Board version", version, "unchanged"
+            return
+
+        known = dict((c['CardUrl'], c.get('ListingHash'))
+                     for c in db['cards'].find({'CardUrl': {'$exists': True}},
+                                               {'CardUrl': True,
+                                                'ListingHash': True}))
+        changed = []
+        current = []
+        for lane in lanes:
             print lane['Title'], len(lane['Cards'])
             for card in lane['Cards']:
-                self.store_card(board, lane, card)
+                url = self.card_url.format(card['Id'])
+                current.append(url)
+                if self.full or known.get(url) != listing_hash(lane, card):
+                    changed.append((lane, card))
+
+        pool = ThreadPool(self.workers)
+        try:
+            for lane, card, tasks in pool.imap_unordered(
+                    self.fetch_tasks, changed):
+                self.store_card(board, lane, card, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        query = {'CardUrl': {'$exists': True, '$nin': current}}
+        removed = db['cards'].distinct('CardUrl', query)
+        db['cards'].delete_many(query)
+        self.ch.message.updated(len(removed))
+        for url in removed:
+            self.ch.message.changed('cards', 'CardUrl', url, 'delete')
+        print "{} cards, {} refreshed, {} removed".format(
+            len(current), len(changed), len(removed))
+
+        # Only record the version once every card is stored, so an
+        # interrupted sync is picked up again next time.
+        if version is not None:
+            with self.ch.db_entry(db['cards'], {'Url': self.board_url}) as c:
+                c['Version'] = version
+
+    def refresh_card(self, card_id):
+        """Fetch the board and the taskboard of one card, and store the
+        card, or delete it if it has left the board. The board version isn't
+        recorded, so the next sync still looks for other changed cards."""
+        board, lanes, version = self.get_board()
+        for lane in lanes:
+            for card in lane['Cards']:
+                if str(card['Id']) == str(card_id):
+                    _, _, tasks = self.fetch_tasks((lane, card))
+                    self.store_card(board, lane, card, tasks)
+                    return
+        url = self.card_url.format(card_id)
+        if db['cards'].delete_one({'CardUrl': url}).deleted_count:
+            self.ch.message.updated()
+            self.ch.message.changed('cards', 'CardUrl', url, 'delete')
+
+    def fetch_tasks(self, (lane, card)):
+        data, status = self.ch.get_url(self.task_url.format(card['Id']), self.auth)
+        return lane, card, json.loads(data)
 
-    def store_card(self, board, lane, card):
+    def store_card(self, board, lane, card, tasks):
         url = self.card_url.format(card['Id'])
-        data, status = self.ch.get_url(self.task_url.format(card['Id']), self.auth)
-        tasks = json.loads(data)
         move_url = 'v1/board/{boardId}/move/card/{cardId}/tasks/{taskId}/lane/'
         with self.ch.db_entry(db['cards'], {'CardUrl': url}) as c:
             c['CardUrl'] = url
+            c['ListingHash'] = listing_hash(lane, card)
             c['BoardTitle'] = board['ReplyData'][0]['Title']
             c['LaneTitle'] = lane['Title']
             c['Title'] = card['Title']
@@ -78,11 +158,21 @@ class CardGetter:
                         })
 
 
-def collect(settings, very_cached=False):
+def collect(settings, very_cached=False, workers=DEFAULT_WORKERS, full=False):
     with MessageBroadcaster() as message:
         ch = CollectorHelpers(message, very_cached)
-        cg = CardGetter(settings, ch)
+        cg = CardGetter(settings, ch, workers, full)
         cg.get_cards()
+        return message.changes
+
+
+def refresh_card(settings, card_id):
+    """Refresh one card without waiting for the next sync. Returns the
+    number of changes."""
+    with MessageBroadcaster() as message:
+        ch = CollectorHelpers(message)
+        CardGetter(settings, ch).refresh_card(card_id)
+        return message.changes
 
 
 def main():
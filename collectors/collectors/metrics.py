@@ -0,0 +1,249 @@
+"""Counters and latency histograms for the collectors.
+
+Metrics are kept in memory by the module level registry and can be served
+in the Prometheus text format with serve(). Every MongoDB command run by any
+client created after this module is imported is counted by collection and
+whether it reads or writes.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import cProfile
+import datetime
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+from pymongo import monitoring
+
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+           300)
+
+MONGO_READS = frozenset(['find', 'getMore', 'count', 'distinct', 'aggregate',
+                         'explain'])
+MONGO_WRITES = frozenset(['insert', 'update', 'delete', 'findAndModify'])
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                          for k, v in pairs) + '}'
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauge_functions = []
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(value)
+
+    @contextmanager
+    def timed(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def add_gauges(self, fn):
+        """fn is called when rendering, and returns (name, value) pairs"""
+        self._gauge_functions.append(fn)
+
+    def take(self):
+        """Return the counters and histograms recorded so far and start
+        again from zero. Pass the result to merge() to add them to another
+        registry."""
+        with self._lock:
+            taken = (self._counters, self._histograms)
+            self._counters = {}
+            self._histograms = {}
+        return taken
+
+    def merge(self, taken):
+        """Add counters and histograms returned by take()"""
+        counters, histograms = taken
+        with self._lock:
+            for key, value in counters.iteritems():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, h in histograms.iteritems():
+                mine = self._histograms.setdefault(key, Histogram())
+                mine.counts = [a + b for a, b in zip(mine.counts, h.counts)]
+                mine.sum += h.sum
+                mine.count += h.count
+
+    def counters(self):
+        """A copy of every counter, and the count and sum of every histogram"""
+        with self._lock:
+            values = dict(self._counters)
+            for (name, labels), h in self._histograms.items():
+                values[(name + '_count', labels)] = h.count
+                values[(name + '_sum', labels)] = h.sum
+        return values
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                lines.append('{}{} {}'.format(name, _format_labels(labels),
+                                              value))
+            for (name, labels), h in sorted(self._histograms.items()):
+                total = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), h.counts):
+                    total += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _format_labels(labels, [('le', bound)]), total))
+                lines.append('{}_sum{} {}'.format(
+                    name, _format_labels(labels), h.sum))
+                lines.append('{}_count{} {}'.format(
+                    name, _format_labels(labels), h.count))
+        for fn in self._gauge_functions:
+            for name, value in fn():
+                lines.append('{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+timed = registry.timed
+
+
+def after_fork():
+    """Call at the start of a forked worker process. The registry's lock may
+    have been held by another thread when we forked, so it is replaced, and
+    the worker starts counting from zero so that what it takes() and sends
+    back to the parent is only its own work."""
+    registry._lock = threading.Lock()
+    registry.take()
+
+
+class MongoCommandCounter(monitoring.CommandListener):
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, basestring):
+            collection = ''
+        if event.command_name in MONGO_READS:
+            kind = 'read'
+        elif event.command_name in MONGO_WRITES:
+            kind = 'write'
+        else:
+            kind = 'other'
+        inc('mongo_commands_total', kind=kind, command=event.command_name,
+            collection=collection)
+
+    def succeeded(self, event):
+        observe('mongo_command_seconds', event.duration_micros / 1e6,
+                command=event.command_name)
+
+    def failed(self, event):
+        inc('mongo_command_failures_total', command=event.command_name)
+
+
+monitoring.register(MongoCommandCounter())
+
+
+@contextmanager
+def cycle(source, collection=None):
+    """Measure one run of a collector. The change in every counter during the
+    run is saved as a summary document in collection, if given. Counters are
+    shared by everything in the process, so the summary includes any other
+    source that was running at the same time. Summaries are expired by a TTL
+    index on date, see schema.py."""
+    before = registry.counters()
+    start = time.time()
+    try:
+        yield
+    finally:
+        after = registry.counters()
+        summary = {}
+        for (name, labels), value in after.items():
+            delta = value - before.get((name, labels), 0)
+            if delta:
+                label_str = _format_labels(labels) or 'total'
+                summary.setdefault(name, {})[label_str] = delta
+        duration = time.time() - start
+        observe('collector_cycle_seconds', duration, source=source)
+        if collection is not None:
+            collection.insert_one({'source': source, 'start': start,
+                                   'date': datetime.datetime.utcnow(),
+                                   'duration': duration, 'metrics': summary})
+
+
+def profile(fn, path, top=30):
+    """Call fn under cProfile, save the stats to path for later inspection
+    with pstats or a flame graph tool, and print where the time went."""
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(fn)
+    finally:
+        profiler.dump_stats(path)
+        stats = pstats.Stats(profiler)
+        stats.sort_stats('cumulative').print_stats(top)
+        print "Profile saved to", path
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def serve(port, host='127.0.0.1'):
+    """Serve /metrics on host:port from a background thread"""
+    server = MetricsServer((host, port), MetricsHandler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
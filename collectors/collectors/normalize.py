@@ -0,0 +1,183 @@
+#!/usr/bin/python
+
+import json
+import re
+import sys
+import time
+import urlparse
+
+
+MILESTONE_LINK_RE = re.compile(r'\+milestone/(.*)$')
+
+
+def on_project(task, project_name):
+    """Whether a bug task is on project_name or one of its series, rather
+    than on another project whose name starts the same way"""
+    if task.get('target_link'):
+        path = urlparse.urlparse(task['target_link']).path
+        return path.split('/')[2:3] == [project_name]
+    name = task['bug_target_display_name']
+    return name == project_name or name.startswith(project_name + ' ')
+
+
+class TaskNormalizer:
+    """Turns Launchpad bugs and their tasks into the documents we store in
+    bugs_filtered. This has no side effects, so it can be run anywhere and
+    timed on recorded data (see main()).
+
+    Each document has a list of tasks, one slot per milestone in milestone
+    order. A task fills the slot for its milestone, or the closest milestone
+    with the same major.minor version. Tasks that aren't targeted to a known
+    milestone are appended to the end of the list, but only one of them so we
+    limit extra junk.
+    """
+    def __init__(self, project_name, milestones):
+        self.project_name = project_name
+        self.milestones = milestones
+        self._index = dict((m, i) for i, m in enumerate(milestones))
+
+        # When more than one milestone has the same major.minor we take the
+        # last one in sort order.
+        self._major_minor = {}
+        for m in milestones:
+            parts = m.split('.')
+            if len(parts) > 1:
+                self._major_minor[(parts[0], parts[1])] = m
+
+        self._target_re = re.compile(re.escape(project_name) + '/(.*)$')
+        self._milestone_links = {}
+        self._target_links = {}
+
+    def resolve(self, name):
+        """Map a milestone name to one of our milestones if we can"""
+        if name in self._index:
+            return name
+        parts = name.split('.')
+        if len(parts) > 1:
+            return self._major_minor.get((parts[0], parts[1]), name)
+        return name
+
+    def _from_milestone_link(self, link):
+        try:
+            return self._milestone_links[link]
+        except KeyError:
+            pass
+        s = MILESTONE_LINK_RE.search(link)
+        if s:
+            name = self.resolve(s.group(1))
+        else:
+            print "Couldn't parse milestone_link", link
+            name = self.resolve("")
+        self._milestone_links[link] = name
+        return name
+
+    def _from_target_link(self, link):
+        try:
+            return self._target_links[link]
+        except KeyError:
+            pass
+        s = self._target_re.search(link)
+        name = self.resolve(s.group(1) if s else "")
+        self._target_links[link] = name
+        return name
+
+    def milestone(self, task):
+        if task.get('milestone_link'):
+            return self._from_milestone_link(task['milestone_link'])
+        elif task.get('target_link'):
+            return self._from_target_link(task['target_link'])
+        return self.resolve("")
+
+    def tasks(self, tasks):
+        slots = [{'milestone': m} for m in self.milestones]
+        for task in tasks:
+            if not on_project(task, self.project_name):
+                print task['target_link']
+                print task['bug_target_display_name']
+                continue
+            t = {
+                'status': task.get('status'),
+                'importance': task.get('importance'),
+                'assignee_link': task.get('assignee_link'),
+                'milestone_link': task.get('milestone_link'),
+                'target_link': task.get('target_link'),
+                'milestone': self.milestone(task),
+            }
+
+            i = self._index.get(t['milestone'])
+            if i is not None:
+                slots[i] = t
+            elif len(slots) == len(self.milestones):
+                slots.append(t)
+        return slots
+
+    def bug(self, bug, bug_info, tasks, update_time):
+        """Build the bugs_filtered document for a searchTasks entry, the bug
+        it links to and the bug's tasks"""
+        return {
+            'web_link': bug_info.get('web_link'),
+            'tags': bug_info.get('tags'),
+            'title': bug_info.get('title'),
+            'private': bug_info.get('private'),
+            'id': bug_info.get('id'),
+            'project': self.project_name,
+            'target': bug['bug_target_display_name'],
+            'tasks': self.tasks(tasks),
+            'update_time': update_time,
+        }
+
+
+def record(db, project_name, path):
+    """Save the bugs and tasks stored in db to path for benchmark()"""
+    meta = db['projects_meta'].find_one({
+        'k': 'details', 'url': 'https://api.launchpad.net/1.0/' + project_name})
+    bugs = []
+    for bug_info in db['bugs'].find({}, {'_id': False}):
+        tasks = list(db['bug_tasks'].find({'bug_link': bug_info['self_link']},
+                                          {'_id': False}))
+        if not tasks:
+            continue
+        bugs.append({
+            'bug': {'bug_target_display_name':
+                    tasks[0]['bug_target_display_name']},
+            'bug_info': bug_info,
+            'tasks': tasks,
+        })
+    with open(path, 'w') as f:
+        json.dump({'project': project_name, 'milestones': meta['milestones'],
+                   'bugs': bugs}, f)
+    print "Recorded {} bugs to {}".format(len(bugs), path)
+
+
+def benchmark(path, repeat=10):
+    with open(path) as f:
+        recorded = json.load(f)
+    bugs = recorded['bugs']
+    best = None
+    for _ in range(repeat):
+        normalizer = TaskNormalizer(recorded['project'],
+                                    recorded['milestones'])
+        start = time.time()
+        for b in bugs:
+            normalizer.bug(b['bug'], b['bug_info'], b['tasks'], start)
+        duration = time.time() - start
+        best = duration if best is None else min(best, duration)
+    tasks = sum(len(b['tasks']) for b in bugs)
+    print "{} bugs, {} tasks: best of {} {:.4f}s, {:.0f} tasks/s".format(
+        len(bugs), tasks, repeat, best, tasks / best if best else 0)
+
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[1] not in ('record', 'bench'):
+        print "usage: normalize.py record|bench FILE"
+        sys.exit(1)
+    if sys.argv[1] == 'record':
+        import pymongo
+        db = pymongo.MongoClient()['juju_team_status']
+        record(db, 'juju-core', sys.argv[2])
+    else:
+        benchmark(sys.argv[2])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+#!/usr/bin/python
+"""Rebuild bugs, bug_tasks and bugs_filtered from the web cache, without
+talking to Launchpad.
+
+This is for after a change to how bugs are stored, or for starting a new
+node from a copy of the web cache. Cached responses are read with one
+cursor in URL order, which puts each bug next to its pages of tasks. They
+are parsed and normalised in a pool of processes and written back with bulk
+upserts.
+
+    ./rebuild.py [--processes N] [--batch-size N] [PROJECT ...]
+"""
+
+import argparse
+import json
+import multiprocessing
+import re
+import time
+import zlib
+from collections import OrderedDict
+
+from pymongo import ReplaceOne
+
+from collect_lp_bugs import (DEFAULT_PROJECTS, LP_API, SEARCH_STATUSES,
+                             project_bug)
+from normalize import MILESTONE_LINK_RE, TaskNormalizer
+import rollups
+import snapshots
+import storage
+from utils import (CollectorHelpers, MessageBroadcaster, chunks, db,
+                   get_change_log, DEFAULT_BATCH_SIZE)
+
+
+BUG_URL_RE = re.compile(re.escape(LP_API) +
+                        r'bugs/(\d+)(/bug_tasks(\?.*)?)?$')
+
+
+def cached_bodies(match):
+    """Yield (url, body) for every cached response matching match, in URL
+    order, with one aggregate cursor. body is the compressed body, or None
+    if the cache only has the ETag."""
+    pipeline = [
+        {'$match': match},
+        {'$sort': {'url': 1}},
+        {'$lookup': {'from': 'web_cache_bodies', 'localField': 'hash',
+                     'foreignField': '_id', 'as': 'body'}},
+        {'$project': {'url': True, 'body.body': True}},
+    ]
+    for doc in db['web_cache'].aggregate(pipeline, allowDiskUse=True):
+        body = doc['body'][0]['body'] if doc['body'] else None
+        yield doc['url'], body
+
+
+def prefix(url):
+    return {'url': {'$regex': '^' + re.escape(url)}}
+
+
+def collection_entries(url):
+    """The entries of every cached page of a Launchpad collection"""
+    for page_url, body in cached_bodies(prefix(url)):
+        if body is not None:
+            for entry in json.loads(zlib.decompress(body)).get('entries', []):
+                yield page_url, entry
+
+
+def project_milestones(project_name):
+    """Our sorted list of milestone names for a project, from the cache, or
+    from projects_meta if the cache doesn't have them"""
+    project_url = LP_API + project_name
+    for _, body in cached_bodies({'url': project_url}):
+        if body is None:
+            break
+        project = json.loads(zlib.decompress(body))
+        link = project['active_milestones_collection_link']
+        names = set()
+        for _, m in collection_entries(link):
+            names.add(MILESTONE_LINK_RE.search(m['self_link']).group(1))
+        if names:
+            return sorted(names)
+    meta = db['projects_meta'].find_one({'k': 'details', 'url': project_url})
+    return meta['milestones'] if meta else None
+
+
+def cached_page(url):
+    """The cached page at url, parsed, or None if we don't have its body"""
+    for _, body in cached_bodies({'url': url}):
+        if body is not None:
+            return json.loads(zlib.decompress(body))
+    return None
+
+
+def search_entries(project_name, milestones):
+    """{bug_link: searchTasks entry} from the cached pages of the search
+    collect_lp_bugs makes for a project with milestones, following each
+    page's next_collection_link from the first. Pages of older searches are
+    left out. Returns None if any page isn't cached."""
+    search_url = CollectorHelpers(None).search_url(
+        LP_API + project_name,
+        {'milestones': milestones, 'status': SEARCH_STATUSES})
+    # The first page is the search URL with whatever page size we asked for
+    first_re = '^' + re.escape(search_url) + r'&ws\.size=\d+$'
+    first = db['web_cache'].find_one({'url': {'$regex': first_re}},
+                                     sort=[('fetched', -1)])
+    if first is None:
+        print "No cached search results for", project_name
+        return None
+
+    entries = {}
+    url = first['url']
+    while url:
+        page = cached_page(url)
+        if page is None:
+            print "No cached copy of", url
+            return None
+        for entry in page.get('entries', []):
+            entries.setdefault(entry['bug_link'], entry)
+        url = page.get('next_collection_link')
+    return entries
+
+
+def cached_bugs(batch_size):
+    """Yield lists of (bug_link, bug body, task page bodies) from the
+    cache"""
+    batch = []
+    current = None
+    for url, body in cached_bodies(prefix(LP_API + 'bugs/')):
+        m = BUG_URL_RE.match(url)
+        if not m:
+            continue
+        bug_link = LP_API + 'bugs/' + m.group(1)
+        if current is None or current[0] != bug_link:
+            if current is not None:
+                batch.append(current)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            current = [bug_link, None, []]
+        if m.group(2):
+            if body is not None:
+                current[2].append(body)
+        else:
+            current[1] = body
+    if current is not None:
+        batch.append(current)
+    if batch:
+        yield batch
+
+
+# Set in each worker process by _init_worker
+_normalizers = None
+_update_time = None
+
+
+def _init_worker(milestones, update_time):
+    global _normalizers, _update_time
+    _normalizers = dict((p, TaskNormalizer(p, m))
+                        for p, m in milestones.iteritems())
+    _update_time = update_time
+
+
+def _normalize(batch):
+    """Parse and normalise a batch of bugs. Each item is (bug_info or a
+    compressed bug body, compressed task pages, [(project, search entry)]).
+    Returns a list of (bug_info, tasks, bugs_filtered documents)."""
+    results = []
+    for bug_info, pages, searches in batch:
+        if not isinstance(bug_info, dict):
+            bug_info = json.loads(zlib.decompress(bug_info))
+        # A task can be on more than one cached page if the page size has
+        # changed. Keep the order Launchpad gave us.
+        tasks = OrderedDict()
+        for page in pages:
+            for task in json.loads(zlib.decompress(page)).get('entries', []):
+                tasks.setdefault(task['self_link'], task)
+        tasks = tasks.values()
+        filtered = []
+        for project, search in searches:
+            doc = _normalizers[project].bug(search, bug_info, tasks,
+                                            _update_time)
+            doc['project_bug'] = project_bug(project, bug_info['web_link'])
+            filtered.append(doc)
+        results.append((bug_info, tasks, filtered))
+    return results
+
+
+def _bulk_replace(collection, key, docs):
+    if docs:
+        collection.bulk_write([ReplaceOne({key: d[key]}, d, upsert=True)
+                               for d in docs], ordered=False)
+
+
+def _store(results, counts, keys):
+    """Write a batch of results from _normalize, adding to counts and to the
+    keys of the bugs_filtered documents of each project"""
+    bugs = [storage.project('bugs', bug_info) for bug_info, _, _ in results]
+    tasks = [storage.project('bug_tasks', t)
+             for _, bug_tasks, _ in results for t in bug_tasks]
+    filtered = [d for _, _, docs in results for d in docs]
+    _bulk_replace(db['bugs'], 'self_link', bugs)
+    _bulk_replace(db['bug_tasks'], 'self_link', tasks)
+    _bulk_replace(db['bugs_filtered'], 'project_bug', filtered)
+    counts['bugs'] += len(bugs)
+    counts['bug_tasks'] += len(tasks)
+    counts['bugs_filtered'] += len(filtered)
+    for d in filtered:
+        keys[d['project']].append(d['project_bug'])
+
+
+def rebuild(projects=DEFAULT_PROJECTS, processes=None,
+            batch_size=DEFAULT_BATCH_SIZE):
+    start = time.time()
+    milestones = {}
+    searches = {}
+    for p in projects:
+        milestones[p] = project_milestones(p)
+        if milestones[p] is None:
+            print "No cached milestones for", p, "- skipping it"
+            del milestones[p]
+            continue
+        entries = search_entries(p, milestones[p])
+        if entries is None:
+            print "Search results for", p, "aren't all cached - skipping it"
+            del milestones[p]
+            continue
+        for bug_link, entry in entries.iteritems():
+            searches.setdefault(bug_link, []).append((p, entry))
+    print "Read {} search results in {:.2f}s".format(
+        len(searches), time.time() - start)
+
+    def work():
+        """Batches for the workers. Bugs the cache only has the ETag of are
+        read from the bugs collection, a batch at a time."""
+        for batch in cached_bugs(batch_size):
+            batch = [b for b in batch if b[0] in searches and b[2]]
+            missing = [link for link, body, _ in batch if body is None]
+            stored = {}
+            if missing:
+                for doc in db['bugs'].find({'self_link': {'$in': missing}},
+                                           {'_id': False}):
+                    stored[doc['self_link']] = doc
+            yield [(stored[link] if body is None else body, pages,
+                    searches[link])
+                   for link, body, pages in batch
+                   if body is not None or link in stored]
+
+    update_time = time.time()
+    processes = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (milestones, update_time))
+    counts = {'bugs': 0, 'bug_tasks': 0, 'bugs_filtered': 0}
+    keys = dict((p, []) for p in milestones)
+    # work() is read here rather than by the pool. Pool.imap drops an error
+    # raised by the first batch of its iterable and returns nothing, and
+    # with nothing rebuilt every stored bug would be deleted below.
+    try:
+        for group in chunks(work(), processes):
+            for results in pool.map(_normalize, group):
+                _store(results, counts, keys)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Anything not rebuilt wasn't in the last search of its project
+    for p, project_keys in keys.iteritems():
+        db['bugs_filtered'].delete_many(
+            {'project': p, 'project_bug': {'$nin': project_keys}})
+        rollups.recount(db, p)
+
+    duration = time.time() - start
+    total = sum(counts.values())
+    print "Rebuilt {} bugs, {} tasks and {} filtered bugs in {:.2f}s " \
+        "({:.0f} documents/s)".format(
+            counts['bugs'], counts['bug_tasks'], counts['bugs_filtered'],
+            duration, total / duration if duration else 0)
+
+    # Open dashboards can't follow a rebuild change by change, so tell them
+    # to reload everything
+    with MessageBroadcaster() as message:
+        snapshots.build(db, get_change_log().reset())
+        message.updated(total)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('projects', nargs='*', default=DEFAULT_PROJECTS)
+    parser.add_argument('--processes', type=int,
+                        help='worker processes, one per CPU by default')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+    rebuild(args.projects, args.processes, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
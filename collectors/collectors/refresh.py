@@ -0,0 +1,146 @@
+"""Refresh single bugs, milestones and LeanKit cards on demand.
+
+collect_all.py serves a control endpoint on 127.0.0.1:9876 (control_port in
+settings.yaml) that queues a refresh:
+
+    curl -X POST 'http://127.0.0.1:9876/refresh?bug=1234'
+    curl -X POST 'http://127.0.0.1:9876/refresh?milestone=1.25.1'
+    curl -X POST 'http://127.0.0.1:9876/refresh?card=5678'
+
+milestone and bug take an optional project, otherwise every project we
+collect is refreshed. Refreshes run on their own thread, so they never wait
+for a poll. Bugs go first, then cards, then milestones, which take longest,
+and a refresh that is already queued isn't queued again. Only what was asked
+for is fetched, and the web server is pinged as soon as it is stored.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import heapq
+import itertools
+import json
+import threading
+import time
+import traceback
+import urlparse
+
+import metrics
+
+
+# Lower goes first
+PRIORITIES = {'bug': 0, 'card': 1, 'milestone': 2}
+
+
+class Refresher(threading.Thread):
+    """Runs queued refreshes one at a time. handlers maps each kind of
+    refresh we can do to a function that takes the name of the thing to
+    refresh and a project, which may be None, and returns the number of
+    changes."""
+    def __init__(self, handlers):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.handlers = handlers
+        self._heap = []
+        self._queued = set()
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+
+    def request(self, kind, name, project=None):
+        """Queue a refresh. Returns False if the same refresh was already
+        waiting."""
+        if kind not in self.handlers:
+            raise ValueError("Can't refresh a " + kind)
+        key = (kind, name, project)
+        with self._cond:
+            if key in self._queued:
+                metrics.inc('refresh_requests_total', kind=kind,
+                            result='coalesced')
+                return False
+            self._queued.add(key)
+            heapq.heappush(self._heap, (PRIORITIES[kind], next(self._order),
+                                        time.time(), key))
+            self._cond.notify()
+        metrics.inc('refresh_requests_total', kind=kind, result='queued')
+        return True
+
+    def pending(self):
+        with self._cond:
+            return len(self._heap)
+
+    def _next(self):
+        # A request that comes in while its refresh is running is queued
+        # again, as it may be for a change we have already missed.
+        with self._cond:
+            while not self._heap:
+                self._cond.wait()
+            _, _, queued, key = heapq.heappop(self._heap)
+            self._queued.discard(key)
+            return queued, key
+
+    def run(self):
+        while True:
+            queued, (kind, name, project) = self._next()
+            try:
+                changes = self.handlers[kind](name, project)
+            except Exception:
+                traceback.print_exc()
+                metrics.inc('refresh_total', kind=kind, result='error')
+                continue
+            latency = time.time() - queued
+            metrics.inc('refresh_total', kind=kind, result='ok')
+            metrics.observe('refresh_latency_seconds', latency, kind=kind)
+            print "Refreshed {} {}: {} changes in {:.2f}s".format(
+                kind, name, changes, latency)
+
+
+class ControlHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, doc):
+        body = json.dumps(doc)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        parsed = urlparse.urlparse(self.path)
+        if parsed.path != '/refresh':
+            self.send_error(404)
+            return
+        query = dict((k, v[0]) for k, v in
+                     urlparse.parse_qs(parsed.query).iteritems())
+        refresher = self.server.refresher
+        kinds = [k for k in PRIORITIES if k in query]
+        if len(kinds) != 1:
+            self._reply(400, {'error': 'give one of bug, milestone or card'})
+            return
+        kind = kinds[0]
+        name = query[kind]
+        if kind in ('bug', 'card') and not name.isdigit():
+            self._reply(400, {'error': kind + ' must be a number'})
+            return
+        try:
+            queued = refresher.request(kind, name, query.get('project'))
+        except ValueError as e:
+            self._reply(400, {'error': str(e)})
+            return
+        self._reply(202, {'queued': queued, 'pending': refresher.pending()})
+
+
+class ControlServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def serve(refresher, port, host='127.0.0.1'):
+    """Start refresher and serve its control endpoint on host:port from a
+    background thread"""
+    refresher.start()
+    server = ControlServer((host, port), ControlHandler)
+    server.refresher = refresher
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
@@ -0,0 +1,153 @@
+"""Bug counts kept up to date as bugs change, and their history.
+
+bug_rollups holds one document per combination of project, milestone,
+status, importance and assignee that any task has, with the number of tasks
+that have it. Collectors pass the old and new version of every bugs_filtered
+document they change to a Rollup, which turns them into $inc updates, so
+nothing is recounted. recount() rebuilds a project's counts from scratch.
+
+bug_history holds the counts by status and importance of each milestone,
+one document per time bucket. Every poll updates the current bucket at each
+resolution. A milestone with no open tasks left gets buckets with zero
+counts, so its history reaches zero rather than stopping. Fine grained
+buckets have an expires date, and are deleted by the TTL index on it (see
+schema.py) as they age, leaving the coarser ones.
+"""
+
+import datetime
+import json
+
+from pymongo import UpdateOne
+
+
+FIELDS = ('project', 'milestone', 'status', 'importance', 'assignee')
+
+# (name, bucket length in seconds, how long to keep buckets or None to keep
+# them forever)
+RESOLUTIONS = (
+    ('hour', 60 * 60, 14 * 24 * 60 * 60),
+    ('day', 24 * 60 * 60, None),
+)
+
+
+def task_keys(doc):
+    """The rollup keys of the tasks of a bugs_filtered document. Slots for
+    milestones the bug has no task in are skipped."""
+    keys = []
+    for task in doc.get('tasks', []):
+        if 'status' not in task:
+            continue
+        keys.append((doc.get('project'), task.get('milestone'),
+                     task.get('status'), task.get('importance'),
+                     task.get('assignee_link')))
+    return keys
+
+
+def _id(key):
+    return json.dumps(key)
+
+
+class Rollup:
+    """Accumulates changes to the counts in bug_rollups until flush()"""
+    def __init__(self, collection):
+        self._collection = collection
+        self._deltas = {}
+
+    def add(self, doc, sign=1):
+        for key in task_keys(doc):
+            self._deltas[key] = self._deltas.get(key, 0) + sign
+
+    def remove(self, doc):
+        self.add(doc, -1)
+
+    def changed(self, old, new):
+        if old:
+            self.remove(old)
+        if new:
+            self.add(new)
+
+    def flush(self):
+        ops = []
+        lowered = []
+        for key, delta in self._deltas.iteritems():
+            if delta == 0:
+                continue
+            if delta < 0:
+                lowered.append(_id(key))
+            ops.append(UpdateOne(
+                {'_id': _id(key)},
+                {'$inc': {'count': delta},
+                 '$setOnInsert': dict(zip(FIELDS, key))},
+                upsert=True))
+        self._deltas = {}
+        if ops:
+            self._collection.bulk_write(ops, ordered=False)
+        if lowered:
+            # Only counts we took from can have reached zero
+            self._collection.delete_many({'_id': {'$in': lowered},
+                                          'count': {'$lte': 0}})
+
+
+def recount(db, project_name):
+    """Replace the counts for a project with ones counted from
+    bugs_filtered"""
+    pipeline = [
+        {'$match': {'project': project_name}},
+        {'$unwind': '$tasks'},
+        {'$match': {'tasks.status': {'$exists': True}}},
+        {'$group': {'_id': {'milestone': '$tasks.milestone',
+                            'status': '$tasks.status',
+                            'importance': '$tasks.importance',
+                            'assignee': '$tasks.assignee_link'},
+                    'count': {'$sum': 1}}},
+    ]
+    docs = []
+    for group in db['bugs_filtered'].aggregate(pipeline, allowDiskUse=True):
+        key = (project_name,) + tuple(group['_id'].get(f) for f in FIELDS[1:])
+        doc = dict(zip(FIELDS, key))
+        doc['_id'] = _id(key)
+        doc['count'] = group['count']
+        docs.append(doc)
+    db['bug_rollups'].delete_many({'project': project_name})
+    if docs:
+        db['bug_rollups'].insert_many(docs, ordered=False)
+
+
+def _empty_counts():
+    return {'total': 0, 'status': {}, 'importance': {}}
+
+
+def record_history(db, project_name, now, milestones=()):
+    """Save the current counts of each milestone of a project into the
+    current bucket at each resolution. Any of milestones, and any milestone
+    with tasks in the previous bucket, that has no counts now is saved as
+    zero."""
+    counted = {}
+    for doc in db['bug_rollups'].find({'project': project_name}):
+        m = counted.setdefault(doc['milestone'], _empty_counts())
+        m['total'] += doc['count']
+        for field in ('status', 'importance'):
+            value = doc[field] or 'None'
+            m[field][value] = m[field].get(value, 0) + doc['count']
+
+    ops = []
+    for name, length, keep in RESOLUTIONS:
+        start = int(now // length * length)
+        recent = db['bug_history'].find(
+            {'project': project_name, 'resolution': name,
+             'start': {'$gte': start - length}, 'total': {'$gt': 0}},
+            {'milestone': True})
+        bucket = dict((m, _empty_counts()) for m in
+                      set(milestones).union(d['milestone'] for d in recent))
+        bucket.update(counted)
+        for milestone, counts in bucket.iteritems():
+            doc = dict(counts, project=project_name, milestone=milestone,
+                       resolution=name, start=start, time=now)
+            if keep is not None:
+                doc['expires'] = datetime.datetime.utcfromtimestamp(
+                    start + keep)
+            ops.append(UpdateOne(
+                {'_id': _id([project_name, milestone, name, start])},
+                {'$set': doc}, upsert=True))
+    if ops:
+        db['bug_history'].bulk_write(ops, ordered=False)
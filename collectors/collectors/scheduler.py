@@ -0,0 +1,154 @@
+import random
+import threading
+import time
+import traceback
+
+import metrics
+
+
+class Source:
+    """Something to poll. fn is called with no arguments and returns how many
+    changes it found.
+
+    After each run the interval is halved if anything changed and grown by
+    half if nothing did, staying between min_interval and max_interval, so
+    busy sources are polled more often than quiet ones. Failed runs are
+    retried after an exponential back off instead. Every delay has up to
+    jitter * delay added or removed so sources don't fall into lock step.
+
+    If profile is set, the next run is done under cProfile and the stats are
+    saved to profile-<name>-<time>.pstats."""
+    def __init__(self, name, fn, interval, min_interval=None,
+                 max_interval=None, jitter=0.1, backoff=30, max_backoff=3600,
+                 profile=False):
+        self.name = name
+        self.fn = fn
+        self.profile = profile
+        self.interval = interval
+        self.min_interval = min_interval or interval
+        self.max_interval = max_interval or interval
+        self.jitter = jitter
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.running = False
+        self.next_run = time.time()
+        self.last_start = None
+        self.last_duration = None
+        self.last_changes = None
+        self.last_error = None
+        self.errors = 0
+        self.runs = 0
+
+    def _jittered(self, delay):
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def finished(self, changes):
+        self.errors = 0
+        self.last_error = None
+        self.last_changes = changes
+        if changes:
+            self.interval = max(self.min_interval, self.interval / 2.0)
+        else:
+            self.interval = min(self.max_interval, self.interval * 1.5)
+        self.next_run = time.time() + self._jittered(self.interval)
+
+    def failed(self, error):
+        self.errors += 1
+        self.last_error = error
+        delay = min(self.max_backoff, self.backoff * 2 ** (self.errors - 1))
+        self.next_run = time.time() + self._jittered(delay)
+
+    def state(self):
+        return {
+            'name': self.name,
+            'running': self.running,
+            'interval': self.interval,
+            'next_run': self.next_run,
+            'last_start': self.last_start,
+            'last_duration': self.last_duration,
+            'last_changes': self.last_changes,
+            'last_error': self.last_error,
+            'errors': self.errors,
+            'runs': self.runs,
+        }
+
+
+class Scheduler:
+    """Runs each Source on its own thread when it is due. A source is never
+    started again while its last run is still going. If state_collection is
+    given, the state of each source is saved to it after every run. If
+    metrics_collection is given, a summary of the metrics recorded during each
+    run is saved to it."""
+    def __init__(self, sources, state_collection=None, metrics_collection=None):
+        self.sources = sources
+        self._state_collection = state_collection
+        self._metrics_collection = metrics_collection
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def _run(self, source):
+        source.last_start = time.time()
+        try:
+            with metrics.cycle(source.name, self._metrics_collection):
+                if source.profile:
+                    source.profile = False
+                    path = 'profile-{}-{}.pstats'.format(
+                        source.name, int(source.last_start))
+                    changes = metrics.profile(source.fn, path) or 0
+                else:
+                    changes = source.fn() or 0
+        except Exception:
+            traceback.print_exc()
+            with self._lock:
+                source.failed(traceback.format_exc().splitlines()[-1])
+        else:
+            with self._lock:
+                source.finished(changes)
+        finally:
+            with self._lock:
+                source.running = False
+                source.runs += 1
+                source.last_duration = time.time() - source.last_start
+            self._save(source)
+            print "{name}: {last_changes} changes in {last_duration:.1f}s, " \
+                "next run in {0:.0f}s".format(
+                    source.next_run - time.time(), **source.state())
+            self._wake.set()
+
+    def _save(self, source):
+        if self._state_collection is None:
+            return
+        state = source.state()
+        self._state_collection.update_one({'name': source.name},
+                                          {'$set': state}, upsert=True)
+
+    def run_pending(self):
+        """Start every source that is due. Returns the time until the next
+        source is due."""
+        now = time.time()
+        wait = None
+        with self._lock:
+            for source in self.sources:
+                if source.running:
+                    continue
+                if source.next_run <= now:
+                    source.running = True
+                    t = threading.Thread(target=self._run, args=(source,))
+                    t.daemon = True
+                    t.start()
+                    continue
+                delay = source.next_run - now
+                if wait is None or delay < wait:
+                    wait = delay
+        return wait
+
+    def run_forever(self):
+        while True:
+            self._wake.clear()
+            wait = self.run_pending()
+            self._wake.wait(wait if wait is not None else 60)
+
+    def state(self):
+        with self._lock:
+            return [s.state() for s in self.sources]
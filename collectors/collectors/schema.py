@@ -0,0 +1,228 @@
+#!/usr/bin/python
+"""The indexes each collection needs, and a check that they are used.
+
+INDEXES declares the indexes of every collection we query by anything but
+_id. ensure() creates any that are missing and brings existing ones in line
+with their declaration: a changed TTL is altered in place with collMod, and
+any other change drops and rebuilds the index. Before a unique index is
+built, documents that share its key are removed, keeping the newest. They
+are all copies of something we fetch again on the next poll.
+
+Documents in a collection with a TTL index are deleted by MongoDB once the
+date in the indexed field is more than expireAfterSeconds old. Only BSON
+dates expire, so a document without the field is kept.
+
+HOT_QUERIES lists every query the collectors make on each poll, and those
+the web server makes often. check() explains each of them and raises
+SchemaError if any would scan a whole collection. Reads of every document
+of a collection, such as those of snapshots.build(), and lookups by _id
+aren't listed.
+
+    ./schema.py [ensure|check]
+
+collect_all.py does both when it starts.
+"""
+
+import sys
+
+import pymongo
+from bson.son import SON
+
+
+def index(*keys, **options):
+    return [(k, pymongo.ASCENDING) for k in keys], options
+
+
+INDEXES = {
+    'bugs': [index('self_link', unique=True)],
+    'bug_tasks': [index('self_link', unique=True), index('bug_link')],
+    'projects': [index('self_link', unique=True)],
+    # Documents stored before bugs were collected from more than one project
+    # have no project_bug, until remove_legacy_bugs() deletes them
+    'bugs_filtered': [index('project_bug', unique=True, sparse=True),
+                      index('project', 'id'), index('id')],
+    'projects_meta': [index('k', 'url')],
+    'sync_state': [index('name', unique=True)],
+    'bug_rollups': [index('project')],
+    'bug_history': [index('project', 'milestone', 'resolution', 'start'),
+                    index('expires', expireAfterSeconds=0)],
+    'web_cache': [index('url', unique=True), index('fetched'),
+                  index('hash')],
+    'change_log': [index('seq', unique=True), index('time')],
+    'cards': [index('CardUrl', unique=True, sparse=True),
+              index('Url', unique=True, sparse=True)],
+    'lp_people': [index('name', unique=True)],
+    'lp_teams': [index('name', unique=True)],
+    'lp_membership': [index('person', 'team', unique=True)],
+    'collector_state': [index('name', unique=True)],
+    'collector_metrics': [index('date', expireAfterSeconds=30 * 24 * 60 * 60)],
+}
+
+# (collection, filter, sort)
+HOT_QUERIES = [
+    ('bugs', {'self_link': 'x'}, None),
+    ('bug_tasks', {'self_link': {'$in': ['x']}}, None),
+    ('projects', {'self_link': 'x'}, None),
+    ('bugs_filtered', {'project_bug': {'$in': ['x']}}, None),
+    ('bugs_filtered', {'project': 'x'}, None),
+    ('bugs_filtered', {'project': 'x', 'id': {'$in': [1]}}, None),
+    ('bugs_filtered', {'project': {'$nin': ['x']}}, None),
+    ('bugs_filtered', {}, [('id', pymongo.ASCENDING)]),
+    ('projects_meta', {'k': 'details', 'url': 'x'}, None),
+    ('projects_meta', {'k': 'details', 'url': {'$nin': ['x']}}, None),
+    ('projects_meta', {'k': 'list'}, None),
+    ('projects_meta', {}, [('k', pymongo.ASCENDING)]),
+    ('sync_state', {'name': 'x'}, None),
+    ('sync_state', {'name': 'x', '$or': [{'writer': None},
+                                         {'writer.expires': {'$lt': 0}}]},
+     None),
+    ('bug_rollups', {'project': 'x'}, None),
+    ('bug_history', {'project': 'x', 'milestone': 'x', 'resolution': 'day'},
+     [('start', pymongo.ASCENDING)]),
+    ('bug_history', {'project': 'x', 'resolution': 'day',
+                     'start': {'$gte': 0}, 'total': {'$gt': 0}}, None),
+    ('web_cache', {'url': 'x'}, None),
+    ('web_cache', {'url': {'$in': ['x']}, 'hash': {'$exists': True}}, None),
+    ('web_cache', {'fetched': {'$lt': 0}}, None),
+    ('web_cache', {'fetched': {'$exists': False}}, None),
+    ('change_log', {}, [('seq', pymongo.ASCENDING)]),
+    ('change_log', {'seq': {'$gt': 0}}, [('seq', pymongo.ASCENDING)]),
+    ('change_log', {'time': {'$lt': 0}}, None),
+    ('cards', {'CardUrl': 'x'}, None),
+    ('cards', {'CardUrl': {'$exists': True}}, None),
+    ('cards', {'CardUrl': {'$exists': True, '$nin': ['x']}}, None),
+    ('cards', {'Url': 'x'}, None),
+    ('lp_people', {'name': {'$in': ['x']}}, None),
+    ('lp_teams', {'name': {'$in': ['x']}}, None),
+    ('lp_membership', {'person': 'x', 'team': 'x'}, None),
+    ('collector_state', {'name': 'x'}, None),
+]
+
+# Options that can't be changed without rebuilding the index
+REBUILD_OPTIONS = ('unique', 'sparse', 'partialFilterExpression')
+
+
+class SchemaError(Exception):
+    pass
+
+
+def _key(keys):
+    return tuple((field, int(direction)) for field, direction in keys)
+
+
+def dedupe(collection, fields, sparse=False):
+    """Delete all but the newest of each set of documents with the same
+    values of fields. Returns how many were deleted."""
+    pipeline = []
+    if sparse:
+        pipeline.append({'$match': dict((f, {'$exists': True})
+                                        for f in fields)})
+    pipeline += [
+        {'$sort': {'_id': 1}},
+        {'$group': {'_id': dict((f.replace('.', '_'), '$' + f)
+                                for f in fields),
+                    'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+    ]
+    doomed = []
+    for group in collection.aggregate(pipeline, allowDiskUse=True):
+        doomed.extend(group['ids'][:-1])
+    if doomed:
+        collection.delete_many({'_id': {'$in': doomed}})
+    return len(doomed)
+
+
+def _create(collection, keys, options):
+    if options.get('unique'):
+        removed = dedupe(collection, [k for k, _ in keys],
+                         options.get('sparse', False))
+        if removed:
+            print "{}: removed {} duplicates".format(collection.name, removed)
+    return collection.create_index(keys, **options)
+
+
+def ensure(db, indexes=INDEXES):
+    """Create or update the declared indexes. Returns a list of what was
+    done. Indexes that aren't declared are left alone."""
+    done = []
+    for name, wanted in sorted(indexes.iteritems()):
+        collection = db[name]
+        existing = {}
+        for index_name, info in collection.index_information().iteritems():
+            existing[_key(info['key'])] = (index_name, info)
+
+        for keys, options in wanted:
+            found = existing.get(_key(keys))
+            if found is None:
+                done.append('{}: created {}'.format(
+                    name, _create(collection, keys, options)))
+                continue
+
+            index_name, info = found
+            if any(info.get(o) != options.get(o) for o in REBUILD_OPTIONS
+                   if info.get(o) or options.get(o)):
+                collection.drop_index(index_name)
+                done.append('{}: rebuilt {}'.format(
+                    name, _create(collection, keys, options)))
+            elif info.get('expireAfterSeconds') != options.get(
+                    'expireAfterSeconds'):
+                if 'expireAfterSeconds' not in options:
+                    collection.drop_index(index_name)
+                    collection.create_index(keys, **options)
+                else:
+                    db.command('collMod', name, index={
+                        'keyPattern': SON(keys),
+                        'expireAfterSeconds': options['expireAfterSeconds']})
+                done.append('{}: changed the TTL of {}'.format(
+                    name, index_name))
+    for line in done:
+        print line
+    return done
+
+
+def stages(plan):
+    """Yield the name of every stage of a query plan"""
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for v in plan.itervalues():
+            for stage in stages(v):
+                yield stage
+    elif isinstance(plan, list):
+        for v in plan:
+            for stage in stages(v):
+                yield stage
+
+
+def check(db, queries=HOT_QUERIES):
+    """Explain each of queries and raise SchemaError if any of them scans a
+    whole collection"""
+    scans = []
+    for name, query, sort in queries:
+        cursor = db[name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain()['queryPlanner']['winningPlan']
+        if 'COLLSCAN' in stages(plan):
+            scans.append('{} {}{}'.format(
+                name, query, ' sorted by {}'.format(sort) if sort else ''))
+    if scans:
+        raise SchemaError("Queries that scan a whole collection:\n  " +
+                          "\n  ".join(scans))
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command not in (None, 'ensure', 'check'):
+        print "usage: schema.py [ensure|check]"
+        sys.exit(1)
+    from utils import db
+    if command in (None, 'ensure'):
+        ensure(db)
+    if command in (None, 'check'):
+        check(db)
+        print "No hot query scans a whole collection"
+
+
+if __name__ == '__main__':
+    main()
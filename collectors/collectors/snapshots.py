@@ -0,0 +1,102 @@
+"""Pre-serialised views of the data the web UI shows.
+
+build() renders the full bug list, the project metadata and a bug list per
+milestone and per assignee as JSON. It compresses each one and stores it in
+the snapshots collection with the SHA-1 of its JSON as an ETag. The web
+server sends these blobs as they are, so a dashboard load doesn't need a
+query or a JSON encode.
+"""
+
+import gzip
+import hashlib
+import json
+import time
+from StringIO import StringIO
+
+from bson.binary import Binary
+
+
+def encode(docs):
+    """JSON with a stable key order, so unchanged data has an unchanged
+    hash"""
+    return json.dumps(docs, sort_keys=True, separators=(',', ':'))
+
+
+def compress(data):
+    out = StringIO()
+    # A fixed mtime keeps the output the same for the same input
+    with gzip.GzipFile(fileobj=out, mode='wb', mtime=0) as f:
+        f.write(data)
+    return out.getvalue()
+
+
+def assignee_name(link):
+    """https://api.launchpad.net/1.0/~someone -> someone"""
+    return link.rsplit('~', 1)[-1]
+
+
+def views(bugs, meta):
+    """Returns {snapshot name: list of documents}"""
+    result = {'bugs': bugs, 'meta': meta}
+    for bug in bugs:
+        milestones = set()
+        assignees = set()
+        for task in bug.get('tasks', []):
+            # Milestones without a task for this bug have a placeholder slot
+            # with just the milestone name in it
+            if 'status' not in task:
+                continue
+            milestones.add(task['milestone'])
+            if task.get('assignee_link'):
+                assignees.add(assignee_name(task['assignee_link']))
+        for m in milestones:
+            result.setdefault('milestone/' + m, []).append(bug)
+        for a in assignees:
+            result.setdefault('assignee/' + a, []).append(bug)
+    return result
+
+
+def build(db, seq=None):
+    """Render every snapshot from bugs_filtered and projects_meta. Only
+    snapshots whose content changed are written, and snapshots for
+    milestones or assignees that no longer have any bugs are deleted.
+    seq is the change log sequence number the snapshots are up to date
+    with, and is saved on unchanged snapshots too, so clients that load
+    them don't ask for changes the log no longer has. Returns how many
+    snapshots were written or deleted."""
+    bugs = list(db['bugs_filtered'].find({}, {'_id': False})
+                .sort('id', 1))
+    meta = list(db['projects_meta'].find({}, {'_id': False}).sort('k', 1))
+    stored = dict((s['_id'], s['etag']) for s in
+                  db['snapshots'].find({}, {'etag': True}))
+
+    written = 0
+    unchanged = []
+    now = time.time()
+    rendered = views(bugs, meta)
+    for name, docs in rendered.iteritems():
+        data = encode(docs)
+        etag = '"{}"'.format(hashlib.sha1(data).hexdigest())
+        if stored.get(name) == etag:
+            unchanged.append(name)
+            continue
+        body = compress(data)
+        db['snapshots'].replace_one({'_id': name}, {
+            '_id': name,
+            'etag': etag,
+            'body': Binary(body),
+            'size': len(data),
+            'compressed_size': len(body),
+            'count': len(docs),
+            'seq': seq,
+            'built': now,
+        }, upsert=True)
+        written += 1
+    if unchanged:
+        db['snapshots'].update_many({'_id': {'$in': unchanged}},
+                                    {'$set': {'seq': seq, 'built': now}})
+
+    gone = [name for name in stored if name not in rendered]
+    if gone:
+        db['snapshots'].delete_many({'_id': {'$in': gone}})
+    return written + len(gone)
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+"""Compact storage.
+
+By default we keep everything Launchpad sends us: the parsed bugs, tasks and
+projects, and every response body in the web cache. In compact mode only the
+fields listed in FIELDS are kept in those collections, and the web cache
+keeps only the ETag of responses that are stored in one of them. A 304 for
+one of those is answered from the collection instead.
+
+Turn it on with compact_storage: true in settings.yaml, and shrink an
+existing database with:
+
+    ./storage.py migrate [--compact]
+"""
+
+import sys
+
+from pymongo import UpdateOne
+
+
+# The fields of each Launchpad collection that anything reads
+FIELDS = {
+    'bugs': ('self_link', 'id', 'title', 'tags', 'private', 'web_link',
+             'bug_tasks_collection_link', 'date_last_updated'),
+    'bug_tasks': ('self_link', 'bug_link', 'bug_target_display_name',
+                  'status', 'importance', 'assignee_link', 'milestone_link',
+                  'target_link'),
+    'projects': ('self_link', 'name', 'display_name',
+                 'active_milestones_collection_link'),
+}
+
+# Collections reported on by stats()
+COLLECTIONS = ('bugs', 'bug_tasks', 'projects', 'bugs_filtered', 'web_cache',
+               'web_cache_bodies')
+
+compact = False
+
+
+def configure(compact_storage=False):
+    global compact
+    compact = compact_storage
+
+
+def project(collection_name, doc):
+    """The part of doc to store in collection_name"""
+    if not compact or collection_name not in FIELDS:
+        return doc
+    fields = FIELDS[collection_name]
+    return dict((k, v) for k, v in doc.iteritems() if k in fields)
+
+
+def keep_body(collection_name):
+    """Whether to keep the response bodies of entries of collection_name in
+    the web cache"""
+    return not compact or collection_name not in FIELDS
+
+
+def stats(db, names=COLLECTIONS):
+    """Returns {collection name: collStats}"""
+    result = {}
+    for name in names:
+        result[name] = db.command('collStats', name)
+    return result
+
+
+def report(before, after=None):
+    def mb(n):
+        return n / (1024.0 * 1024.0)
+
+    print "{:<18} {:>9} {:>10} {:>11} {:>10}".format(
+        'collection', 'documents', 'data (MB)', 'on disk (MB)',
+        'index (MB)')
+    for name in sorted(before):
+        rows = [before[name]]
+        if after is not None:
+            rows.append(after[name])
+        for label, s in zip(['', '  after'], rows):
+            print "{:<18} {:>9} {:>10.1f} {:>11.1f} {:>10.1f}".format(
+                label or name, s.get('count', 0), mb(s.get('size', 0)),
+                mb(s.get('storageSize', 0)), mb(s.get('totalIndexSize', 0)))
+
+
+def strip_fields(collection, fields, batch_size=500):
+    """Remove every field but fields from each document of collection.
+    Returns how many documents were changed."""
+    changed = 0
+    ops = []
+    for doc in collection.find():
+        extra = [k for k in doc if k != '_id' and k not in fields]
+        if not extra:
+            continue
+        ops.append(UpdateOne({'_id': doc['_id']},
+                             {'$unset': dict((k, '') for k in extra)}))
+        if len(ops) >= batch_size:
+            changed += collection.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        changed += collection.bulk_write(ops, ordered=False).modified_count
+    return changed
+
+
+def migrate(db, cache, compact_files=False, batch_size=500):
+    """Shrink a database written in the default mode to compact mode. With
+    compact_files, also run the compact command on each collection so
+    MongoDB gives the space back."""
+    before = stats(db)
+    for name, fields in sorted(FIELDS.items()):
+        print name + ":", strip_fields(db[name], fields, batch_size), \
+            "documents trimmed"
+
+        links = db[name].distinct('self_link')
+        dropped = 0
+        for i in range(0, len(links), batch_size):
+            dropped += cache.drop_bodies(links[i:i + batch_size])
+        print name + ":", dropped, "cached bodies dropped"
+    cache.evict()
+
+    if compact_files:
+        for name in COLLECTIONS:
+            db.command('compact', name)
+    report(before, stats(db))
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] != 'migrate':
+        print "usage: storage.py migrate [--compact]"
+        sys.exit(1)
+    from utils import db, get_cache
+    configure(True)
+    migrate(db, get_cache(), '--compact' in sys.argv)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,52 +4,409 @@ import urllib
 import json
 import pymongo
 import os
-import copy
 import lazr
 import requests
 import time
+import random
 from pprint import pprint
-import re
 from requests.auth import HTTPBasicAuth
 import base64
+import threading
+import itertools
+import sys
+from contextlib import contextmanager
+from pymongo import UpdateOne
+from bson import BSON
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from requests.adapters import HTTPAdapter
+from cache import ResponseCache
+from changes import ChangeLog
+import storage
+from collections import OrderedDict
+import metrics
 
 
 BASE_DIR = os.path.dirname(__file__)
-client = pymongo.MongoClient()
-db = client['juju_team_status']
+
+
+class Database:
+    """The database the collectors share, connected on first use. A
+    MongoClient must not be used in a process forked from the one that
+    created it, so each process gets its own client. Collections are looked
+    up with db['name'] as with a pymongo Database."""
+    def __init__(self, name='juju_team_status', uri=None):
+        self._name = name
+        self._uri = uri
+        self._options = {}
+        self._pid = None
+        self._db = None
+        self._lock = threading.Lock()
+
+    def configure(self, uri=None, name=None, **client_options):
+        """Use a different server or database from now on. client_options
+        are passed to MongoClient."""
+        with self._lock:
+            self._uri = uri
+            self._name = name or self._name
+            self._options = client_options
+            self._pid = None
+
+    def get(self):
+        """The pymongo Database for this process"""
+        with self._lock:
+            if self._pid != os.getpid():
+                client = pymongo.MongoClient(self._uri, **self._options)
+                self._db = client[self._name]
+                self._pid = os.getpid()
+            return self._db
+
+    def __getitem__(self, name):
+        return self.get()[name]
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+db = Database()
+
+# Reads documents as undecoded BSON, so we can cheaply decode more than one
+# copy of them
+_RAW_BSON = CodecOptions(document_class=RawBSONDocument)
+
+# Number of keep-alive connections held open to each host
+DEFAULT_POOL_SIZE = 16
+
+# Number of writes sent to the database in one bulk_write
+DEFAULT_BATCH_SIZE = 500
+
+# Number of entries to ask for in each page of a Launchpad collection. 300 is
+# the most Launchpad will return.
+DEFAULT_PAGE_SIZE = 300
+
+# Requests that fail with a connection error or one of these statuses are
+# retried up to MAX_RETRIES times, waiting RETRY_BACKOFF seconds, then twice
+# that and so on, give or take a little
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+MAX_RETRIES = 3
+RETRY_BACKOFF = 1.0
+
+# Seconds to wait for a connection to a host, and then for each read from it,
+# unless get_session is given other timeouts
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+
+# After this many failed requests in a row to a host, requests to it fail at
+# once for CIRCUIT_COOLDOWN seconds
+CIRCUIT_THRESHOLD = 5
+CIRCUIT_COOLDOWN = 30
+
+_session = None
+_session_pool_size = None
+_session_timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+_session_lock = threading.Lock()
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+_cache = None
+_cache_options = {}
+_cache_lock = threading.Lock()
+
+_change_log = None
+_change_log_lock = threading.Lock()
+
+# Launchpad access token, loaded from the database on first use
+_lp_credentials = None
+_lp_credentials_lock = threading.Lock()
+
+
+class TimeoutSession(requests.Session):
+    """A Session that gives every request a timeout unless it has its own"""
+    def __init__(self, timeout):
+        requests.Session.__init__(self)
+        self.timeout = timeout
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return requests.Session.request(self, *args, **kwargs)
+
+
+def get_session(pool_size=None, timeout=None):
+    """Return the HTTP session shared by all collectors. Connections are
+    pooled per host and kept alive between requests. Requests time out
+    after timeout, a (connect, read) pair of seconds. pool_size and timeout
+    only have an effect on the first call, which creates the session."""
+    global _session, _session_pool_size, _session_timeout
+    with _session_lock:
+        if _session is None:
+            if pool_size is None:
+                pool_size = _session_pool_size or DEFAULT_POOL_SIZE
+            _session_pool_size = pool_size
+            if timeout is not None:
+                _session_timeout = tuple(timeout)
+            adapter = HTTPAdapter(pool_connections=pool_size,
+                                  pool_maxsize=pool_size)
+            _session = TimeoutSession(_session_timeout)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def get_cache(**kwargs):
+    """Return the response cache shared by all collectors. Arguments are
+    passed to ResponseCache on the first call, which creates the cache."""
+    global _cache, _cache_options
+    with _cache_lock:
+        if _cache is None:
+            _cache_options = kwargs or _cache_options
+            _cache = ResponseCache(db, **_cache_options)
+        return _cache
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    def __init__(self, host):
+        requests.exceptions.ConnectionError.__init__(
+            self, "Not sending requests to {} for now, it keeps failing"
+            .format(host))
+        self.host = host
+
+
+class CircuitBreaker:
+    """Counts failed requests to a host. After threshold failures in a row,
+    check() raises CircuitOpenError for cooldown seconds, so a host that is
+    down costs us one error rather than a timeout per request. After that
+    requests are let through again, but one more failure opens the circuit
+    again."""
+    def __init__(self, host, threshold=CIRCUIT_THRESHOLD,
+                 cooldown=CIRCUIT_COOLDOWN):
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self._lock = threading.Lock()
+
+    def check(self):
+        with self._lock:
+            if (self.opened is not None and
+                    time.time() - self.opened < self.cooldown):
+                raise CircuitOpenError(self.host)
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened is None:
+                    metrics.inc('http_circuit_open_total', host=self.host)
+                self.opened = time.time()
+
+
+def get_breaker(host):
+    """Return the circuit breaker for requests to host"""
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host)
+        return _breakers[host]
+
+
+def get_change_log():
+    """Return the change log shared by all collectors"""
+    global _change_log
+    with _change_log_lock:
+        if _change_log is None:
+            _change_log = ChangeLog(db)
+        return _change_log
+
+
+def after_fork():
+    """Call at the start of a forked worker process. The HTTP session, the
+    response cache and the change log are created again in the worker, with
+    the options they were first created with, rather than sharing the
+    parent's connections. Cached responses are shared through the database.
+    Any lock another thread of the parent held when we forked would never be
+    released, so every lock is replaced."""
+    global _session, _session_lock, _cache, _cache_lock
+    global _change_log, _change_log_lock, _breakers, _breakers_lock
+    global _lp_credentials_lock
+    _session = None
+    _session_lock = threading.Lock()
+    _cache = None
+    _cache_lock = threading.Lock()
+    _change_log = None
+    _change_log_lock = threading.Lock()
+    _breakers = {}
+    _breakers_lock = threading.Lock()
+    _lp_credentials_lock = threading.Lock()
+    db._lock = threading.Lock()
+    metrics.after_fork()
+
+
+class LaunchpadCredentials:
+    """An OAuth access token held in memory. Everything but the timestamp and
+    nonce of the Authorization header is fixed, so it is built once."""
+    def __init__(self, token):
+        self._prefix = (
+            'OAuth realm="https://api.launchpad.net/", '
+            'oauth_consumer_key="{oauth_consumer_key}", '
+            'oauth_token="{oauth_token}", '
+            'oauth_signature_method="PLAINTEXT", '
+            'oauth_signature="&{oauth_token_secret}", '.format(**token))
+
+    def header(self):
+        return '{}oauth_timestamp="{}", oauth_nonce="{}", oauth_version="1.0"'.format(
+            self._prefix, int(time.time()),
+            base64.urlsafe_b64encode(os.urandom(32)))
+
+
+def get_lp_credentials():
+    global _lp_credentials
+    with _lp_credentials_lock:
+        if _lp_credentials is None:
+            token = db['server_auth'].find_one({'name': 'lp_oauth_access'})
+            _lp_credentials = LaunchpadCredentials(token)
+        return _lp_credentials
+
+
+def forget_lp_credentials():
+    global _lp_credentials
+    with _lp_credentials_lock:
+        _lp_credentials = None
 
 
 class MessageBroadcaster:
     """Sends messages to the web server when updates happen, but rate limited
-    so we don't spam the server."""
+    so we don't spam the server.
+
+    Changes to individual documents reported with Message.changed() are
+    coalesced, so a document changed several times is only reported once,
+    and written to the change log at most every min_interval seconds. The
+    server is pinged with the sequence number of the last change each time,
+    and once more when the with block ends."""
 
     class Message:
-        def __init__(self):
+        def __init__(self, on_change=None):
             self.messages = {}
+            self.changes = 0
+            self._on_change = on_change
+            self._pending = OrderedDict()
+            self._lock = threading.Lock()
 
-        def updated(self):
+        def updated(self, count=1):
+            self.messages['updated'] = True
+            self.changes += count
+
+        def changed(self, collection, field, key, op='upsert'):
+            """Record that the document in collection with field == key was
+            upserted or deleted"""
+            with self._lock:
+                self._pending.pop((collection, field, key), None)
+                self._pending[(collection, field, key)] = op
             self.messages['updated'] = True
+            if self._on_change:
+                self._on_change()
+
+        def take_changes(self):
+            with self._lock:
+                pending, self._pending = self._pending, OrderedDict()
+            return [k + (op,) for k, op in pending.iteritems()]
+
+    def __init__(self, min_interval=2):
+        self.min_interval = min_interval
+        self._last_sent = time.time()
+        self._send_lock = threading.Lock()
 
     def __enter__(self):
-        self._m = self.Message()
+        self._m = self.Message(self._maybe_send)
         return self._m
 
+    def _maybe_send(self):
+        if time.time() - self._last_sent < self.min_interval:
+            return
+        # Whoever gets the lock sends everything pending, so nobody waits
+        if self._send_lock.acquire(False):
+            try:
+                self._send()
+            finally:
+                self._send_lock.release()
+
     def _send(self):
+        self._last_sent = time.time()
+        seq = get_change_log().append(self._m.take_changes())
         if self._m.messages.get('updated'):
+            self._m.messages['updated'] = False
             try:
-                requests.get("http://127.0.0.1:9874/ping")
-            except requests.exceptions.ConnectionError:
+                get_session().get("http://127.0.0.1:9874/ping",
+                                  params={'seq': seq})
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout):
                 print "Unable to ping server to tell it about new data"
 
     def __exit__(self, type, value, traceback):
-        self._send()
+        with self._send_lock:
+            self._send()
+
+
+def find_one_pair(collection, query):
+    """Find a document and return two independent copies of it, one to hand
+    out for modification and one to diff against later. Decoding the raw
+    BSON twice is far cheaper than a deepcopy of a large document."""
+    raw = collection.with_options(codec_options=_RAW_BSON).find_one(query)
+    if raw is None:
+        return None, None
+    return decode_pair(raw)
+
+
+def decode_pair(raw):
+    return BSON(raw.raw).decode(), BSON(raw.raw).decode()
+
+
+def field_diff(old, new, volatile=()):
+    """Compare two versions of a document field by field. Returns the update
+    that turns old into new, or None if they are the same, and whether any
+    field not listed in volatile was changed."""
+    set_fields = {}
+    unset_fields = {}
+    for k, v in new.iteritems():
+        if k != '_id' and (k not in old or old[k] != v):
+            set_fields[k] = v
+    for k in old:
+        if k != '_id' and k not in new:
+            unset_fields[k] = ''
+
+    update = {}
+    if set_fields:
+        update['$set'] = set_fields
+    if unset_fields:
+        update['$unset'] = unset_fields
+    changed = any(k not in volatile
+                  for k in itertools.chain(set_fields, unset_fields))
+    return update or None, changed
+
+
+def db_entry_result(update, changed):
+    if update is None:
+        return 'unchanged'
+    if changed:
+        return 'changed'
+    return 'volatile'
 
 
 class DBEntry:
-    def __init__(self, message, collection, query, data=None):
+    """Wraps up the lookup, modify, save interaction with mongodb. Only the
+    fields that were modified are written back. Changes to the fields listed
+    in volatile, such as bookkeeping timestamps, are saved but don't count as
+    an update."""
+    def __init__(self, message, collection, query, data=None, volatile=()):
         self._collection = collection
         self._query = query
         self._message = message
+        self._volatile = volatile
 
         if data is not None:
             for f in query:
@@ -58,24 +415,42 @@ class DBEntry:
             if status['nModified'] == 0:
                 if self._message:
                     self._message.updated()
+                    self._changed()
+
+    def _empty(self):
+        return {}
 
     def __enter__(self):
-        self._entry = self._collection.find_one(self._query)
+        self._entry, self.public_entry = find_one_pair(self._collection,
+                                                       self._query)
 
         if self._entry is None:
-            self._entry = {}
-
-        self.public_entry = copy.deepcopy(self._entry)
+            self._entry = self._empty()
+            self.public_entry = self._empty()
 
         return self.public_entry
 
     def __exit__(self, type, value, traceback):
-        if '_id' not in self.public_entry and '_id' in self._entry:
-            self.public_entry['_id'] = self._entry['_id']
-        if self.public_entry != self._entry:
-            self._collection.save(self.public_entry)
-            if self._message:
-                self._message.updated()
+        update, changed = field_diff(self._entry, self.public_entry,
+                                     self._volatile)
+        metrics.inc('db_entries_total', collection=self._collection.name,
+                    result=db_entry_result(update, changed))
+        if update is None:
+            return
+        if '_id' in self._entry:
+            self._collection.update_one({'_id': self._entry['_id']}, update)
+        else:
+            self._collection.update_one(self._query, update, upsert=True)
+        if changed and self._message:
+            self._message.updated()
+            self._changed()
+
+    def _changed(self):
+        if len(self._query) == 1:
+            field, key = self._query.items()[0]
+        else:
+            field, key = None, tuple(sorted(self._query.items()))
+        self._message.changed(self._collection.name, field, key)
 
 
 class DBEntryExact(DBEntry):
@@ -83,27 +458,159 @@ class DBEntryExact(DBEntry):
     mongodb, but the contract with the user is that the query used to look
     up the entry is a simple key, value pair (or set of pairs), so they can be
     used to initialise an empty dictionary when no entry is found"""
-    def __enter__(self):
-        self._entry = self._collection.find_one(self._query)
+    def _empty(self):
+        return self._query.copy()
+
+
+class DBBatch:
+    """A unit of work over one collection, where documents are identified by
+    a single key field. prefetch() reads the stored documents for a set of
+    keys in one query. Changes made through entry() and upsert() are queued
+    as field level updates and written with unordered bulk_write calls of up
+    to batch_size operations, either when the queue is full, on flush() or
+    when leaving the with block. volatile works as it does for DBEntry."""
+    def __init__(self, message, collection, key, batch_size=DEFAULT_BATCH_SIZE,
+                 volatile=()):
+        self._message = message
+        self._collection = collection
+        self._key = key
+        self._batch_size = batch_size
+        self._volatile = volatile
+        self._stored = {}
+        self._ops = []
+        # Keys of queued updates that changed more than volatile fields
+        self._changed = []
 
-        if self._entry is None:
-            self._entry = self._query.copy()
+    def __enter__(self):
+        return self
 
-        self.public_entry = copy.deepcopy(self._entry)
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.flush()
+
+    def prefetch(self, keys):
+        keys = [k for k in set(keys) if k not in self._stored]
+        raw_collection = self._collection.with_options(codec_options=_RAW_BSON)
+        for chunk in chunks(keys, self._batch_size):
+            for doc in raw_collection.find({self._key: {'$in': chunk}}):
+                self._stored[doc[self._key]] = doc
+            for k in chunk:
+                self._stored.setdefault(k, None)
+
+    def _get(self, key):
+        """Returns two copies of the stored document for key"""
+        if key not in self._stored:
+            self.prefetch([key])
+        if self._stored[key] is None:
+            return None, None
+        return decode_pair(self._stored[key])
+
+    def entry(self, key):
+        return BatchEntry(self, key)
+
+    def upsert(self, key, data):
+        """Replace the document for key with data"""
+        data[self._key] = key
+        old = self._get(key)[0]
+        self._update(key, old or {}, data)
+
+    def _update(self, key, old, new):
+        update, changed = field_diff(old, new, self._volatile)
+        metrics.inc('db_entries_total', collection=self._collection.name,
+                    result=db_entry_result(update, changed))
+        if update is None:
+            return
+        stored = dict(new)
+        if '_id' in old:
+            stored['_id'] = old['_id']
+        self._stored[key] = RawBSONDocument(BSON.encode(stored))
+        if changed:
+            self._changed.append(key)
+        self._ops.append(UpdateOne({self._key: key}, update, upsert=True))
+        if len(self._ops) >= self._batch_size:
+            self._write()
+
+    def _write(self):
+        if not self._ops:
+            return
+        ops, self._ops = self._ops, []
+        self._collection.bulk_write(ops, ordered=False)
+        changed, self._changed = self._changed, []
+        if changed and self._message:
+            self._message.updated(len(changed))
+            for key in changed:
+                self._message.changed(self._collection.name, self._key, key)
+
+    def flush(self):
+        """Write queued changes and forget prefetched documents"""
+        self._write()
+        self._stored = {}
+
+
+class BatchEntry:
+    """Like DBEntry, but the lookup and save go through a DBBatch"""
+    def __init__(self, batch, key):
+        self._batch = batch
+        self._key = key
 
+    def __enter__(self):
+        self._entry, self.public_entry = self._batch._get(self._key)
+        if self._entry is None:
+            self._entry = {}
+            self.public_entry = {}
         return self.public_entry
 
+    def __exit__(self, type, value, traceback):
+        if type is not None:
+            return
+        self._batch._update(self._key, self._entry, self.public_entry)
+
+
+class LaunchpadError(Exception):
+    def __init__(self, url, status_code):
+        Exception.__init__(self, "{} returned {}".format(url, status_code))
+        self.url = url
+        self.status_code = status_code
+
+
+class Prefetch(threading.Thread):
+    """Calls fn(*args) in the background. get() waits for the result, or
+    raises the exception fn raised."""
+    def __init__(self, fn, *args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._fn = fn
+        self._args = args
+        self._result = None
+        self._error = None
+        self.start()
+
+    def run(self):
+        try:
+            self._result = self._fn(*self._args)
+        except Exception:
+            self._error = sys.exc_info()
+
+    def get(self):
+        self.join()
+        if self._error:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
 
 class CollectorHelpers:
-    def __init__(self, message, very_cached=False, clean_db=False):
+    def __init__(self, message, very_cached=False, clean_db=False,
+                 page_size=DEFAULT_PAGE_SIZE):
         self.message = message
         self.very_cached = very_cached
+        self.page_size = page_size
 
         if clean_db:
             # Clean out the database
             print db.collection_names()
             for c in db.collection_names():
-                if c not in [u'system.indexes', u'web_cache']:
+                if c not in [u'system.indexes', u'web_cache',
+                             u'web_cache_bodies']:
                     db[c].drop()
 
     def lp_login(self):
@@ -119,7 +626,7 @@ class CollectorHelpers:
                     'oauth_signature_method': 'PLAINTEXT',
                     'oauth_signature': '&',
                 }
-                r = requests.post("https://launchpad.net/+request-token", data=payload)
+                r = get_session().post("https://launchpad.net/+request-token", data=payload)
                 if r.status_code == 200:
                     auth_bits = urlparse.parse_qs(r.text)
                     req_token['oauth_token'] = auth_bits['oauth_token'][0]
@@ -145,7 +652,7 @@ class CollectorHelpers:
                 'oauth_signature_method': 'PLAINTEXT',
                 'oauth_signature': '&' + self.auth['oauth_token_secret'],
             }
-            r = requests.post("https://launchpad.net/+access-token", data=payload)
+            r = get_session().post("https://launchpad.net/+access-token", data=payload)
             if r.status_code == 200:
                 print "OAuth completed :-)"
                 auth_bits = urlparse.parse_qs(r.text)
@@ -155,59 +662,127 @@ class CollectorHelpers:
                 access_token['oauth_token_secret'] = auth_bits['oauth_token_secret'][0]
                 access_token['oauth_consumer_key'] = 'next_up'
 
-    def get_url_lp_oauth(self, url):
-        with DBEntryExact(None, db['server_auth'],
-                          {'name': 'lp_oauth_access'}) as access_token:
-            at = access_token.copy()
-            at['oauth_timestamp'] = int(time.time())
-            at['oauth_nonce'] = base64.urlsafe_b64encode(os.urandom(32))
-            header_auth = """OAuth realm="https://api.launchpad.net/",
-                oauth_consumer_key="{oauth_consumer_key}",
-                oauth_token="{oauth_token}",
-                oauth_signature_method="PLAINTEXT",
-                oauth_signature="&{oauth_token_secret}",
-                oauth_timestamp="{oauth_timestamp}",
-                oauth_nonce="{oauth_nonce}",
-                oauth_version="1.0"
-                """.format(**at)
-            header_auth = re.sub('\s+', ' ', header_auth, re.MULTILINE)
-            headers = {'Authorization': header_auth}
-
-            return self.get_url(url, headers=headers)
-
-    def get_url(self, url, auth=None, headers={}):
-        with DBEntryExact(self.message, db['web_cache'], {'url': url}) as c:
-            if self.very_cached and c.get('content'):
-                # Yes, we are returning status code 200 here. This path is
-                # typically used to fast-populate a database from the web cache
-                # so we want to consider everything as new.
-                return c['content'], 200
-
-            if 'headers' in c and 'etag' in c['headers']:
-                headers['if-none-match'] = c['headers']['etag']
-            if auth:
-                auth = HTTPBasicAuth(auth[0], auth[1])
-            r = requests.get(url, headers=headers, auth=auth)
-
+        # The access token is saved on leaving the with block above, so any
+        # copy we are holding in memory is out of date.
+        forget_lp_credentials()
+
+    def get_url_lp_oauth(self, url, store_body=True, cached=True):
+        headers = {'Authorization': get_lp_credentials().header()}
+        return self.get_url(url, headers=headers, store_body=store_body,
+                            cached=cached)
+
+    def get_url(self, url, auth=None, headers=None, store_body=True,
+                cached=True):
+        """Fetch url, sending the ETag of our cached copy if we have one.
+        With store_body=False the cache only keeps the ETag, and a 304
+        returns None as the content. With cached=False the cache isn't
+        used at all, for URLs we will never ask for again."""
+        # Callers may be running in a thread pool, so never modify a shared
+        # dictionary of headers.
+        headers = dict(headers or {})
+        host = urlparse.urlparse(url).netloc
+        if auth:
+            auth = HTTPBasicAuth(auth[0], auth[1])
+        if not cached:
+            r = self._request(url, host, headers, auth)
+            if r.status_code != 200:
+                print "Warning: ", url, " returned ", r.status_code
+            print url, r.status_code
+            return r.content, r.status_code
+
+        cache = get_cache()
+        cached = cache.get(url)
+        if (self.very_cached and cached is not None and
+                cached.content is not None):
+            # Yes, we are returning status code 200 here. This path is
+            # typically used to fast-populate a database from the web cache
+            # so we want to consider everything as new.
+            metrics.inc('http_responses_total', host=host,
+                        status='very_cached')
+            return cached.content, 200
+
+        if cached is not None and cached.etag:
+            headers['if-none-match'] = cached.etag
+        r = self._request(url, host, headers, auth)
+
+        if r.status_code == 304 and cached is not None:
+            content = cached.content
+            if cached.hash is None:
+                # Move an entry written by an older version to the new store
+                cache.put(url, content, cached.etag)
+            else:
+                cache.revalidated(url)
+        else:
+            content = r.content
+            etag = None
             if r.status_code == 200:
-                c['content'] = r.content
-                c['headers'] = {}
-                if 'etag' in r.headers:
-                    c['headers'] = {'etag': r.headers['etag']}
-            elif r.status_code == 304:
-                pass  # Do nothing - returning from cache
+                etag = r.headers.get('etag')
             else:
-                c['content'] = r.content
-                c['headers'] = {}
                 print "Warning: ", url, " returned ", r.status_code
                 print r.reason
                 print r.content
+            cache.put(url, content, etag, store_body)
+
+        print url, r.status_code
+        return content, r.status_code
+
+    def _request(self, url, host, headers, auth):
+        """GET url, retrying connection errors and the statuses in
+        RETRY_STATUSES with exponential back off. Raises the last connection
+        error, or returns the last response, once the retries run out."""
+        breaker = get_breaker(host)
+        attempt = 0
+        while True:
+            breaker.check()
+            try:
+                with metrics.timed('http_request_seconds', host=host):
+                    r = get_session().get(url, headers=headers, auth=auth)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout):
+                breaker.failure()
+                metrics.inc('http_responses_total', host=host,
+                            status='error')
+                if attempt >= MAX_RETRIES:
+                    raise
+            else:
+                metrics.inc('http_responses_total', host=host,
+                            status=str(r.status_code))
+                if r.status_code not in RETRY_STATUSES:
+                    breaker.success()
+                    return r
+                breaker.failure()
+                if attempt >= MAX_RETRIES:
+                    return r
+            metrics.inc('http_retries_total', host=host)
+            time.sleep(RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+            attempt += 1
+
+    def _loads(self, url, content, refetch):
+        """Parse a JSON response. A body that doesn't parse, such as one
+        that was cut short, is dropped from the cache and fetched once more
+        with refetch()."""
+        try:
+            return json.loads(content)
+        except ValueError:
+            pass
+        print "Invalid JSON from", url, "- fetching it again"
+        metrics.inc('http_invalid_json_total',
+                    host=urlparse.urlparse(url).netloc)
+        get_cache().discard(url)
+        content, status_code = refetch()
+        if status_code >= 400:
+            raise LaunchpadError(url, status_code)
+        try:
+            return json.loads(content)
+        except ValueError:
+            raise LaunchpadError(url, 'invalid JSON')
 
-            print url, r.status_code
-            return c['content'], r.status_code
+    def db_entry(self, collection, query, data=None, volatile=()):
+        return DBEntry(self.message, collection, query, data, volatile)
 
-    def db_entry(self, collection, query, data=None):
-        return DBEntry(self.message, collection, query, data)
+    def db_batch(self, collection, key, batch_size=DEFAULT_BATCH_SIZE,
+                 volatile=()):
+        return DBBatch(self.message, collection, key, batch_size, volatile)
 
     def lp_entry_to_db(self, collection, entry):
         with DBEntry(self.message, collection, {'self_link': entry.self_link}) as p:
@@ -222,30 +797,138 @@ class CollectorHelpers:
         if self.very_cached:
             with DBEntry(self.message, collection, {'self_link': url}) as p:
                 if 'self_link' in p:
+                    metrics.inc('lp_get_total', collection=collection.name,
+                                result='very_cached')
                     return p, 0
 
-        content, status_code = self.get_url_lp_oauth(url)
+        store_body = storage.keep_body(collection.name)
+        with metrics.timed('lp_get_seconds', collection=collection.name):
+            content, status_code = self.get_url_lp_oauth(url, store_body)
+            if content is None:
+                # Not modified, and in compact storage the document we
+                # stored is all we have
+                stored = collection.find_one({'self_link': url},
+                                             {'_id': False})
+                if stored is not None:
+                    metrics.inc('lp_get_total', collection=collection.name,
+                                result=str(status_code))
+                    return stored, status_code
+                get_cache().discard(url)
+                content, status_code = self.get_url_lp_oauth(url, store_body)
+        metrics.inc('lp_get_total', collection=collection.name,
+                    result=str(status_code))
         if status_code >= 400:
             print "Error fetching", url
             return {}, status_code
 
-        data = json.loads(content)
+        data = self._loads(url, content,
+                           lambda: self.get_url_lp_oauth(url, store_body))
         with DBEntry(self.message, collection, {'self_link': url}) as p:
-            for k, v in data.iteritems():
+            for k, v in storage.project(collection.name, data).iteritems():
                 p[k] = v
         return data, status_code
 
-    def lp_search(self, url, args={}, auth=None):
+    def _lp_page(self, url, cached=True):
+        content, status_code = self.get_url_lp_oauth(url, cached=cached)
+        if status_code >= 400:
+            raise LaunchpadError(url, status_code)
+        return url, self._loads(
+            url, content, lambda: self.get_url_lp_oauth(url, cached=cached))
+
+    def lp_pages(self, url, size=None, cached=True):
+        """Yield (page URL, entries) for each page of a Launchpad
+        collection, following next_collection_link. Pages hold size entries
+        (page_size by default) and the next page is fetched while the
+        entries of the current one are being processed. Any page URL can be
+        passed back in as url to carry on from that page. With cached=False
+        the pages aren't cached."""
+        size = size or self.page_size
+        if 'ws.size=' not in url:
+            url += ('&' if '?' in url else '?') + 'ws.size=' + str(size)
+
+        page_url, page = self._lp_page(url, cached)
+        while page is not None:
+            next_page = None
+            if page.get('next_collection_link'):
+                next_page = Prefetch(self._lp_page,
+                                     page['next_collection_link'], cached)
+            yield page_url, page['entries']
+            page_url, page = next_page.get() if next_page else (None, None)
+
+    def lp_collection(self, url, size=None, cached=True):
+        """Yield the entries of a Launchpad collection"""
+        for _, entries in self.lp_pages(url, size, cached):
+            for entry in entries:
+                yield entry
+
+    def lp_search(self, url, args={}, auth=None, size=None, cached=True):
+        """Yield the bug tasks returned by searchTasks on url"""
+        return self.lp_collection(self.search_url(url, args), size, cached)
+
+    def search_url(self, url, args={}):
+        """The URL of a searchTasks call on url"""
         arg_str = "?ws.op=searchTasks"
         for k, v in args.iteritems():
+            if isinstance(v, basestring):
+                arg_str += '&' + k + '=' + urllib.quote(v)
+                continue
             chunk = k + '=["'
             chunk += '","'.join(v)
             chunk += '"]'
             arg_str += '&' + urllib.quote(chunk)
-        url = urlparse.urljoin(url, arg_str)
-        content, status_code = self.get_url_lp_oauth(url)
-
-        return str(content)
+        return urlparse.urljoin(url, arg_str)
+
+
+class StageTimer:
+    """Accumulates wall clock time spent in named stages of a collection run
+    so we can see where a slow poll spends its time. Stage times are also
+    recorded in the collector_stage_seconds metric, labelled with source."""
+    def __init__(self, source=''):
+        self.source = source
+        self.stages = []
+        self._totals = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name, duration):
+        if name not in self._totals:
+            self.stages.append(name)
+            self._totals[name] = 0.0
+        self._totals[name] += duration
+        metrics.observe('collector_stage_seconds', duration,
+                        source=self.source, stage=name)
+
+    def iterate(self, name, iterable):
+        """Yield from iterable, counting time spent waiting for each item
+        against the named stage."""
+        it = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def report(self):
+        for name in self.stages:
+            print "  {:<20} {:8.2f}s".format(name, self._totals[name])
+
+
+def chunks(iterable, size):
+    """Split iterable into lists of up to size items"""
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
 
 
 def copy_fields(source, dest, fields, erase_dest=False):
@@ -1,13 +1,18 @@
 package server
 
 import (
+	"bytes"
+	"compress/gzip"
 	"encoding/json"
 	"fmt"
+	"io"
 	"io/ioutil"
 	"log"
 	"net/http"
 	"os"
 	"strconv"
+	"strings"
+	"time"
 
 	"github.com/dooferlad/openid-go"
 	"github.com/googollee/go-socket.io"
@@ -22,7 +27,13 @@ type ServerState struct {
 	bugs              *mgo.Collection
 	meta              *mgo.Collection
 	cards             *mgo.Collection
-	lpUsers           *mgo.Collection
+	lpMembership      *mgo.Collection
+	changeLog         *mgo.Collection
+	counters          *mgo.Collection
+	snapshots         *mgo.Collection
+	rollups           *mgo.Collection
+	history           *mgo.Collection
+	changeSources     map[string]*mgo.Collection
 	messages          chan string
 	socket            *socketio.Socket
 	myUrl             string
@@ -40,38 +51,18 @@ type ServerSettings struct {
 	PrivatePort  int    "private_port"
 }
 
-type LaunchpadTeam struct {
-	Members []string
-}
-
 func (state ServerState) allowed(response http.ResponseWriter, request *http.Request) bool {
-	// TODO: This clearly could be optimised:
-	// teams could be stored in state and updated after some max age
-	// teams could be transformed into a dictionary to make lookups quicker for large teams
 	session, _ := state.cookieStore.Get(request, "simpleserve")
 	if val, ok := session.Values["lpuser"]; ok {
-		var teams []LaunchpadTeam
-		query := state.lpUsers.Find(bson.M{"name": state.settings.LpTeam})
-		count, err := query.Count()
+		// The people collector keeps one document per person in each team,
+		// including sub-teams, indexed on person and team.
+		count, err := state.lpMembership.Find(
+			bson.M{"person": val, "team": state.settings.LpTeam}).Limit(1).Count()
 		if err != nil {
 			http.Error(response, err.Error(), 500)
 			return false
 		}
-		if count != 1 {
-			http.Error(response, "unexpected team match", 500)
-			return false
-		}
-		err = query.All(&teams)
-		if err != nil {
-			http.Error(response, err.Error(), 500)
-			return false
-		}
-
-		for _, person := range teams[0].Members {
-			if person == val {
-				return true
-			}
-		}
+		return count > 0
 	}
 	return false
 }
@@ -108,17 +99,84 @@ func collectionToJson(response http.ResponseWriter, collection *mgo.Collection)
 	}
 }
 
+// Snapshot is a pre-serialised view rendered by the collectors. Body is
+// gzipped JSON and ETag is derived from the uncompressed JSON.
+type Snapshot struct {
+	Name string "_id"
+	ETag string "etag"
+	Body []byte "body"
+	Seq  int64  "seq"
+}
+
+// serveSnapshot sends a stored snapshot, or a 304 if the client already has
+// it. Clients that don't accept gzip get it decompressed. It returns false
+// if there is no such snapshot.
+func (state ServerState) serveSnapshot(response http.ResponseWriter, request *http.Request, name string) bool {
+	var snapshot Snapshot
+	err := state.snapshots.FindId(name).One(&snapshot)
+	if err == mgo.ErrNotFound {
+		return false
+	}
+	if err != nil {
+		http.Error(response, err.Error(), 500)
+		return true
+	}
+
+	header := response.Header()
+	header.Set("ETag", snapshot.ETag)
+	header.Set("Cache-Control", "no-cache")
+	header.Set("X-Change-Seq", strconv.FormatInt(snapshot.Seq, 10))
+	header.Set("Vary", "Accept-Encoding")
+	if request.Header.Get("If-None-Match") == snapshot.ETag {
+		response.WriteHeader(http.StatusNotModified)
+		return true
+	}
+
+	header.Set("Content-Type", "application/vnd.api+json")
+	if strings.Contains(request.Header.Get("Accept-Encoding"), "gzip") {
+		header.Set("Content-Encoding", "gzip")
+		header.Set("Content-Length", strconv.Itoa(len(snapshot.Body)))
+		response.Write(snapshot.Body)
+		return true
+	}
+	reader, err := gzip.NewReader(bytes.NewReader(snapshot.Body))
+	if err != nil {
+		http.Error(response, err.Error(), 500)
+		return true
+	}
+	defer reader.Close()
+	io.Copy(response, reader)
+	return true
+}
+
 func (state ServerState) apiBugsHandler(response http.ResponseWriter, request *http.Request) {
 	if state.requireLogin(response, request) == false {
 		return
 	}
-	collectionToJson(response, state.bugs)
+	if !state.serveSnapshot(response, request, "bugs") {
+		collectionToJson(response, state.bugs)
+	}
 }
 func (state ServerState) apiMetaHandler(response http.ResponseWriter, request *http.Request) {
 	if state.requireLogin(response, request) == false {
 		return
 	}
-	collectionToJson(response, state.meta)
+	if !state.serveSnapshot(response, request, "meta") {
+		collectionToJson(response, state.meta)
+	}
+}
+
+// apiBugViewHandler serves the bugs with a task in one milestone, or with a
+// task assigned to one person. A view with no bugs is an empty list.
+func (state ServerState) apiBugViewHandler(response http.ResponseWriter, request *http.Request) {
+	if state.requireLogin(response, request) == false {
+		return
+	}
+	vars := mux.Vars(request)
+	if !state.serveSnapshot(response, request, vars["view"]+"/"+vars["name"]) {
+		response.Header().Set("Content-Type", "application/vnd.api+json")
+		response.Write([]byte("[]"))
+	}
 }
 func (state ServerState) apiCardsHandler(response http.ResponseWriter, request *http.Request) {
 	if state.requireLogin(response, request) == false {
@@ -126,8 +184,205 @@ func (state ServerState) apiCardsHandler(response http.ResponseWriter, request *
 	}
 	collectionToJson(response, state.cards)
 }
+
+// apiRollupsHandler sends the number of tasks with each combination of
+// project, milestone, status, importance and assignee.
+func (state ServerState) apiRollupsHandler(response http.ResponseWriter, request *http.Request) {
+	if state.requireLogin(response, request) == false {
+		return
+	}
+	collectionToJson(response, state.rollups)
+}
+
+// apiHistoryHandler sends the bug counts of a milestone over time, oldest
+// first. resolution is "hour" (the last two weeks) or "day" (the default).
+func (state ServerState) apiHistoryHandler(response http.ResponseWriter, request *http.Request) {
+	if state.requireLogin(response, request) == false {
+		return
+	}
+	params := request.URL.Query()
+	resolution := params.Get("resolution")
+	if resolution == "" {
+		resolution = "day"
+	}
+	query := bson.M{"resolution": resolution}
+	if project := params.Get("project"); project != "" {
+		query["project"] = project
+	}
+	if milestone := params.Get("milestone"); milestone != "" {
+		query["milestone"] = milestone
+	}
+	data := []bson.M{}
+	err := state.history.Find(query).Select(bson.M{"_id": 0}).Sort("start").All(&data)
+	if err != nil {
+		http.Error(response, err.Error(), 500)
+		return
+	}
+	response.Header().Set("Content-Type", "application/vnd.api+json")
+	json.NewEncoder(response).Encode(&data)
+}
+
 func (state ServerState) apiPing(response http.ResponseWriter, request *http.Request) {
-	state.messages <- "ping"
+	// Collectors send the sequence number of the last change they logged
+	seq := request.URL.Query().Get("seq")
+	if seq == "" {
+		seq = "db"
+	}
+	state.messages <- seq
+}
+
+// ChangeEvent is an entry in the change_log collection, written by the
+// collectors. Doc is the current version of an upserted document.
+type ChangeEvent struct {
+	Seq        int64       `bson:"seq" json:"seq"`
+	Time       float64     `bson:"time" json:"-"`
+	Collection string      `bson:"collection" json:"collection"`
+	Field      string      `bson:"field" json:"field"`
+	Key        interface{} `bson:"key" json:"key"`
+	Op         string      `bson:"op" json:"op"`
+	Doc        bson.M      `bson:"doc,omitempty" json:"doc,omitempty"`
+}
+
+type changesResponse struct {
+	Seq     int64         `json:"seq"`
+	Reset   bool          `json:"reset"`
+	Changes []ChangeEvent `json:"changes"`
+}
+
+const maxChanges = 1000
+
+// changeGap is how long we wait for an event that has been numbered but not
+// stored. Collectors in different processes number their events before they
+// store them, so a later event can be stored first. One that is still
+// missing after this long is never coming.
+const changeGap = 60 * time.Second
+
+// apiChangesHandler returns the changes made since the sequence number
+// given in the since parameter, along with the current version of each
+// upserted document, so clients can apply them instead of reloading every
+// collection. If the changes have already been trimmed from the log, or
+// there are too many of them, reset is set and the client should reload.
+// Changes stop at the first event that hasn't been stored yet, and seq is the
+// last one returned, so the client asks for the rest next time.
+func (state ServerState) apiChangesHandler(response http.ResponseWriter, request *http.Request) {
+	if state.requireLogin(response, request) == false {
+		return
+	}
+	// Without since we only report the current sequence number, for clients
+	// that are about to load everything.
+	sinceParam := request.URL.Query().Get("since")
+	since, err := strconv.ParseInt(sinceParam, 10, 64)
+	if err != nil {
+		since = 0
+	}
+
+	var result changesResponse
+	var counter struct {
+		Seq int64 "seq"
+	}
+	err = state.counters.FindId("change_log").One(&counter)
+	if err != nil && err != mgo.ErrNotFound {
+		http.Error(response, err.Error(), 500)
+		return
+	}
+	result.Seq = counter.Seq
+	response.Header().Set("Content-Type", "application/vnd.api+json")
+	if sinceParam == "" {
+		result.Reset = true
+		json.NewEncoder(response).Encode(&result)
+		return
+	}
+
+	var oldest ChangeEvent
+	err = state.changeLog.Find(nil).Sort("seq").One(&oldest)
+	if err == mgo.ErrNotFound {
+		result.Reset = since < counter.Seq
+	} else if err != nil {
+		http.Error(response, err.Error(), 500)
+		return
+	} else {
+		result.Reset = oldest.Seq > since+1
+	}
+
+	if !result.Reset {
+		err = state.changeLog.Find(bson.M{"seq": bson.M{"$gt": since}}).
+			Sort("seq").Limit(maxChanges + 1).All(&result.Changes)
+		if err != nil {
+			http.Error(response, err.Error(), 500)
+			return
+		}
+		if len(result.Changes) > maxChanges {
+			result.Reset = true
+		}
+	}
+	if !result.Reset {
+		stale := float64(time.Now().Add(-changeGap).UnixNano()) / 1e9
+		next := since + 1
+		served := 0
+		for _, event := range result.Changes {
+			if event.Seq != next && event.Time > stale {
+				break
+			}
+			next = event.Seq + 1
+			served++
+		}
+		result.Changes = result.Changes[:served]
+		result.Seq = next - 1
+	}
+	if result.Reset {
+		result.Changes = nil
+	} else {
+		state.attachDocs(result.Changes)
+	}
+	json.NewEncoder(response).Encode(&result)
+}
+
+// attachDocs adds the current document to each upsert event for a
+// collection we serve, with one query per collection and key field. Events
+// for a document that has been deleted since are turned into deletes.
+func (state ServerState) attachDocs(changes []ChangeEvent) {
+	type source struct {
+		collection string
+		field      string
+	}
+	keys := make(map[source][]interface{})
+	for _, change := range changes {
+		if _, ok := state.changeSources[change.Collection]; !ok {
+			continue
+		}
+		if change.Op == "upsert" && change.Field != "" {
+			s := source{change.Collection, change.Field}
+			keys[s] = append(keys[s], change.Key)
+		}
+	}
+
+	docs := make(map[source]map[string]bson.M)
+	for s, k := range keys {
+		var found []bson.M
+		err := state.changeSources[s.collection].Find(
+			bson.M{s.field: bson.M{"$in": k}}).All(&found)
+		if err != nil {
+			log.Println("error fetching changed documents:", err)
+			continue
+		}
+		docs[s] = make(map[string]bson.M)
+		for _, doc := range found {
+			docs[s][fmt.Sprint(doc[s.field])] = doc
+		}
+	}
+
+	for i := range changes {
+		change := &changes[i]
+		byKey, ok := docs[source{change.Collection, change.Field}]
+		if !ok || change.Op != "upsert" {
+			continue
+		}
+		if doc, ok := byKey[fmt.Sprint(change.Key)]; ok {
+			change.Doc = doc
+		} else {
+			change.Op = "delete"
+		}
+	}
 }
 
 // forwardUpdatesToSocketIO sends a ping to the connected clients when we
@@ -156,10 +411,10 @@ func (state *ServerState) forwardUpdatesToSocketIO() {
 	http.Handle("/socket.io/", server)
 
 	for {
-		_ = <-state.messages
+		seq := <-state.messages
 		if state.socket != nil {
 			so := *state.socket
-			so.Emit("update", "db")
+			so.Emit("update", seq)
 		}
 	}
 }
@@ -214,7 +469,17 @@ func Run() {
 	state.bugs = db.C("bugs_filtered")
 	state.meta = db.C("projects_meta")
 	state.cards = db.C("cards")
-	state.lpUsers = db.C("lp_teams")
+	state.lpMembership = db.C("lp_membership")
+	state.changeLog = db.C("change_log")
+	state.counters = db.C("counters")
+	state.snapshots = db.C("snapshots")
+	state.rollups = db.C("bug_rollups")
+	state.history = db.C("bug_history")
+	state.changeSources = map[string]*mgo.Collection{
+		"bugs_filtered": state.bugs,
+		"projects_meta": state.meta,
+		"cards":         state.cards,
+	}
 
 	settingsData, err := ioutil.ReadFile("settings.yaml")
 	err = yaml.Unmarshal(settingsData, &state.settings)
@@ -252,7 +517,11 @@ func Run() {
 	// in the settings file, then these could be set up in a for loop and we become more generic.
 	//
 	api.HandleFunc("/bugs", state.apiBugsHandler)
+	api.HandleFunc("/bugs/{view:milestone|assignee}/{name}", state.apiBugViewHandler)
 	api.HandleFunc("/meta", state.apiMetaHandler)
+	api.HandleFunc("/changes", state.apiChangesHandler)
+	api.HandleFunc("/rollups", state.apiRollupsHandler)
+	api.HandleFunc("/history", state.apiHistoryHandler)
 	//api.HandleFunc("/cards", state.apiCardsHandler)
 
 	// Private API
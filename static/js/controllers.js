@@ -16,9 +16,16 @@ mediaControllers.controller('ToolbarCtrl', ['$scope', '$http', '$interval',
     $scope.mapping = {};
     $scope.mapping.milestones = {};
 
+    // Sequence number of the last change we have applied, see applyChanges
+    $scope.seq = null;
+
     $scope.socket = io();
     $scope.socket.on('update', function (msg) {
-      $scope.update();
+      if ($scope.seq === null || typeof $scope.bugs === 'undefined') {
+        $scope.update();
+      } else if (String(msg) !== String($scope.seq)) {
+        $scope.applyChanges();
+      }
     });
 
     $scope.status_options.every(function(name, index){
@@ -41,8 +48,23 @@ mediaControllers.controller('ToolbarCtrl', ['$scope', '$http', '$interval',
 
     $scope.update = function () {
 
-      $http.get('/API/bugs').success(function (data) {
-        $scope.bugs = data;
+      // A snapshot tells us which change it is up to date with. Without one
+      // the bugs come from the live collection, so read the sequence number
+      // first and load them again, so any change made while we load them is
+      // applied again rather than missed.
+      $http.get('/API/bugs').success(function (data, status, headers) {
+        var seq = headers('X-Change-Seq');
+        if (seq !== null) {
+          $scope.seq = Number(seq);
+          $scope.bugs = data;
+          return;
+        }
+        $http.get('/API/changes').success(function (data) {
+          $scope.seq = data.seq;
+          $http.get('/API/bugs').success(function (data) {
+            $scope.bugs = data;
+          });
+        });
       });
 
       /*$http.get('/API/cards').success(function (data) {
@@ -69,6 +91,42 @@ mediaControllers.controller('ToolbarCtrl', ['$scope', '$http', '$interval',
       });
     };
 
+    // Fetch the changes made since we last looked and apply them to the bugs
+    // we already have, rather than downloading every bug again.
+    $scope.applyChanges = function () {
+      $http.get('/API/changes?since=' + $scope.seq).success(function (data) {
+        var reload = data.reset;
+        (data.changes || []).forEach(function (change) {
+          if (change.collection === 'bugs_filtered') {
+            var index = -1;
+            $scope.bugs.some(function (bug, i) {
+              if (bug[change.field] === change.key) {
+                index = i;
+                return true;
+              }
+              return false;
+            });
+            if (change.op === 'delete') {
+              if (index >= 0) {
+                $scope.bugs.splice(index, 1);
+              }
+            } else if (index >= 0) {
+              $scope.bugs[index] = change.doc;
+            } else {
+              $scope.bugs.push(change.doc);
+            }
+          } else if (change.collection === 'projects_meta') {
+            reload = true;
+          }
+        });
+        if (reload) {
+          $scope.update();
+        } else {
+          $scope.seq = data.seq;
+        }
+      });
+    };
+
     $scope.bug_filter = function (bug) {
       if (typeof $scope.milestones === 'undefined') {
         return false;